@@ -1,27 +1,30 @@
 import os
+import sys
 import requests
-import json
 import time
+from datetime import datetime, timezone
 import gspread
+from gestionale import load_state, save_state, get_galleries, get_gspread_client, apply_cli_options, run_stage
 
 # --- CONFIGURAZIONE ---
-# Leggiamo i dati dai segreti di GitHub
+# Leggiamo i dati dai segreti di GitHub (USER_SLUG/SPREADSHEET_ID o GALLERIES sono letti da gestionale)
 SORARE_API_KEY = os.environ.get("SORARE_API_KEY")
-USER_SLUG = os.environ.get("USER_SLUG")
 GSPREAD_CREDENTIALS_JSON = os.environ.get("GSPREAD_CREDENTIALS")
-SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
 
 # Costanti
 API_URL = "https://api.sorare.com/graphql"
 FORMAZIONI_SHEET_NAME = "Formazioni Schierate"
 HEADERS = ["Competizione", "Nome Formazione", "Giocatore", "Card Slug", "Rarità", "Posizione", "Capitano?"]
+STATE_KEY = "check_lineups"
+# Le competizioni in cui l'utente non ha formazioni vengono ricontrollate solo ogni N minuti
+EMPTY_LEADERBOARD_POLL_MINUTES = 120
 
 # --- QUERY GRAPHQL (tradotte dal tuo script) ---
 GET_CURRENT_FIXTURE_QUERY = """
     query GetCurrentFixture {
       so5 {
         so5Fixtures(sport: FOOTBALL, aasmStates: ["started"], first: 1) { 
-          nodes { slug, displayName }
+          nodes { slug, displayName, endDate }
         }
       }
     }"""
@@ -35,11 +38,11 @@ GET_LEADERBOARDS_QUERY = """
       }
     }"""
 
-GET_USER_LINEUPS_QUERY = """
-    query GetUserLineupPublic($slug: String!, $userSlug: String!) {
-      so5 {
-        so5Leaderboard(slug: $slug) {
-          so5LineupsPaginated(first: 10, userSlug: $userSlug) {
+# Le formazioni di più competizioni vengono richieste in un'unica query con alias
+# (lb0, lb1, ...), ognuno con il proprio cursore di paginazione.
+LINEUPS_BATCH_SIZE = 10
+LINEUPS_PAGE_SIZE = 50
+LINEUP_FIELDS = """
             nodes {
               name
               so5Appearances {
@@ -49,10 +52,22 @@ GET_USER_LINEUPS_QUERY = """
                 anyCard { slug, rarityTyped }
               }
             }
-          }
-        }
-      }
-    }"""
+            pageInfo { endCursor, hasNextPage }"""
+
+def build_user_lineups_query(count):
+    """Costruisce la query GetUserLineupsBatch per `count` competizioni."""
+    variable_defs = ", ".join(f"$slug{i}: String!, $cursor{i}: String" for i in range(count))
+    aliases = "\n".join(
+        f"      lb{i}: so5Leaderboard(slug: $slug{i}) {{\n"
+        f"        so5LineupsPaginated(first: {LINEUPS_PAGE_SIZE}, after: $cursor{i}, userSlug: $userSlug) {{{LINEUP_FIELDS}\n        }}\n      }}"
+        for i in range(count)
+    )
+    return f"""
+    query GetUserLineupsBatch($userSlug: String!, {variable_defs}) {{
+      so5 {{
+{aliases}
+      }}
+    }}"""
 
 # --- FUNZIONI ---
 
@@ -75,90 +90,229 @@ def sorare_graphql_fetch(query, variables={}):
         print(f"Errore di rete durante la chiamata API: {e}")
         return None
 
-def main():
-    """Funzione principale che esegue tutto il processo."""
-    print("--- INIZIO VERIFICA FORMAZIONI SCHIERATE ---")
-    start_time = time.time()
-
-    # 1. Autenticazione e preparazione del foglio Google
-    if not all([SORARE_API_KEY, USER_SLUG, GSPREAD_CREDENTIALS_JSON, SPREADSHEET_ID]):
-        print("ERRORE: Uno o più segreti non sono stati configurati (API_KEY, USER_SLUG, GSPREAD_CREDENTIALS, SPREADSHEET_ID).")
-        return
-
-    try:
-        print("Autenticazione a Google Sheets...")
-        credentials = json.loads(GSPREAD_CREDENTIALS_JSON)
-        gc = gspread.service_account_from_dict(credentials)
-        spreadsheet = gc.open_by_key(SPREADSHEET_ID)
-        
-        # Prepara il foglio: crealo se non esiste, puliscilo e scrivi gli header
-        try:
-            worksheet = spreadsheet.worksheet(FORMAZIONI_SHEET_NAME)
-            worksheet.clear()
-        except gspread.WorksheetNotFound:
-            worksheet = spreadsheet.add_worksheet(title=FORMAZIONI_SHEET_NAME, rows="100", cols="20")
-        
-        worksheet.update('A1', [HEADERS])
-        worksheet.format('A1:G1', {'textFormat': {'bold': True}})
-        print(f"Foglio '{FORMAZIONI_SHEET_NAME}' preparato con successo.")
-    except Exception as e:
-        print(f"ERRORE CRITICO durante l'accesso a Google Sheets: {e}")
-        return
+def fetch_user_lineups(leaderboards, user_slug):
+    """
+    Scarica le formazioni dell'utente per tutte le competizioni in batch con alias,
+    seguendo la paginazione di ogni competizione finché hasNextPage è vero.
+    Ritorna ({slug competizione: [formazioni]}, set degli slug non recuperati).
+    """
+    lineups_by_slug = {lb['slug']: [] for lb in leaderboards}
+    failed_slugs = set()
+    pending = [(lb['slug'], None) for lb in leaderboards]
+    while pending:
+        batch, pending = pending[:LINEUPS_BATCH_SIZE], pending[LINEUPS_BATCH_SIZE:]
+        variables = {"userSlug": user_slug}
+        for i, (slug, cursor) in enumerate(batch):
+            variables[f"slug{i}"], variables[f"cursor{i}"] = slug, cursor
+        lineups_data = sorare_graphql_fetch(build_user_lineups_query(len(batch)), variables)
+        if not lineups_data or not lineups_data.get("data"):
+            failed_slugs.update(slug for slug, _ in batch)
+            continue
+        # Un errore su un alias (path ["so5", "lbN", ...]) invalida solo quella competizione
+        failed_aliases = {err["path"][1] for err in lineups_data.get("errors", []) if len(err.get("path") or []) > 1}
+        so5 = lineups_data["data"].get("so5") or {}
+        for i, (slug, cursor) in enumerate(batch):
+            if f"lb{i}" in failed_aliases:
+                failed_slugs.add(slug)
+                continue
+            paginated = (so5.get(f"lb{i}") or {}).get("so5LineupsPaginated") or {}
+            lineups_by_slug[slug].extend(paginated.get("nodes") or [])
+            page_info = paginated.get("pageInfo") or {}
+            if page_info.get("hasNextPage") and page_info.get("endCursor"):
+                pending.append((slug, page_info["endCursor"]))
+        if pending:
+            time.sleep(0.5) # Pausa di cortesia tra i batch
+    return lineups_by_slug, failed_slugs
 
-    # 2. Trova la Game Week in corso
-    print("Cerco la Game Week in corso...")
-    fixture_data = sorare_graphql_fetch(GET_CURRENT_FIXTURE_QUERY)
-    fixture = fixture_data.get("data", {}).get("so5", {}).get("so5Fixtures", {}).get("nodes", [None])[0]
+def resolve_fixture_and_leaderboards(cache):
+    """
+    Ritorna (fixture, competizioni filtrate o None se non recuperabili) usando la cache di stato: la Game Week
+    viene riletta solo dopo la sua endDate e le competizioni solo quando cambia lo slug.
+    Aggiorna `cache` sul posto.
+    """
+    fixture = cache.get('fixture')
+    end_date = (fixture or {}).get('endDate')
+    if fixture and end_date and datetime.fromisoformat(end_date.replace("Z", "+00:00")) > datetime.now(timezone.utc):
+        print(f"Game Week dalla cache: {fixture['displayName']}")
+    else:
+        print("Cerco la Game Week in corso...")
+        fixture_data = sorare_graphql_fetch(GET_CURRENT_FIXTURE_QUERY)
+        fixture = ((fixture_data or {}).get("data", {}).get("so5", {}).get("so5Fixtures", {}).get("nodes") or [None])[0]
+        if not fixture:
+            return None, []
+        print(f"Trovata Game Week: {fixture['displayName']}")
 
-    if not fixture:
-        print("Nessuna Game Week di calcio attiva trovata. Fine.")
-        worksheet.update('A2', [["Nessuna formazione trovata (nessuna Game Week attiva)."]])
-        return
-    print(f"Trovata Game Week: {fixture['displayName']}")
+    if cache.get('fixture', {}).get('slug') == fixture['slug'] and 'leaderboards' in cache:
+        cache['fixture'] = fixture
+        return fixture, cache['leaderboards']
 
-    # 3. Trova le competizioni (leaderboards)
     leaderboards_data = sorare_graphql_fetch(GET_LEADERBOARDS_QUERY, {"slug": fixture['slug']})
-    all_leaderboards = leaderboards_data.get("data", {}).get("so5", {}).get("so5Fixture", {}).get("so5Leaderboards", [])
-    
+    all_leaderboards = (((leaderboards_data or {}).get("data") or {}).get("so5", {}).get("so5Fixture") or {}).get("so5Leaderboards")
+    if all_leaderboards is None:
+        return fixture, None  # Errore API: niente cache, si riprova al prossimo giro
     # Filtra le competizioni come nello script originale
     filtered_leaderboards = [
         lb for lb in all_leaderboards 
         if "arena" not in lb['displayName'].lower() and "common" not in lb['displayName'].lower()
     ]
-    print(f"Trovate {len(filtered_leaderboards)} competizioni valide da controllare per l'utente '{USER_SLUG}'.")
+    # Nuova Game Week: la cache (comprese le competizioni vuote) riparte da zero
+    cache.clear()
+    cache.update({'fixture': fixture, 'leaderboards': filtered_leaderboards, 'empty_leaderboards': {}})  # empty_leaderboards: {utente: {competizione: ts}}
+    return fixture, filtered_leaderboards
+
+def build_formation_rows(leaderboard, lineups):
+    rows = []
+    for lineup in lineups:
+        for appearance in lineup.get("so5Appearances", []):
+            rows.append([
+                leaderboard['displayName'],
+                lineup.get('name', "Senza Nome"),
+                (appearance.get("player") or {}).get("displayName"),
+                (appearance.get("anyCard") or {}).get("slug"),
+                (appearance.get("anyCard") or {}).get("rarityTyped"),
+                appearance.get("position"),
+                "Sì" if appearance.get("captain") else "No"
+            ])
+    return rows
+
+def normalize_row(row):
+    """Porta una riga alla larghezza di HEADERS come stringhe, per confrontarla con quanto letto dal foglio."""
+    row = ["" if value is None else str(value) for value in row[:len(HEADERS)]]
+    return row + [""] * (len(HEADERS) - len(row))
+
+def diff_sheet_updates(existing_rows, new_rows, first_row=2):
+    """
+    Confronta le righe attuali del foglio con quelle nuove e ritorna i range da riscrivere
+    (blocchi contigui di righe cambiate) più lo svuotamento delle righe in eccesso.
+    """
+    existing_rows = [normalize_row(row) for row in existing_rows]
+    new_rows = [normalize_row(row) for row in new_rows]
+    total = max(len(existing_rows), len(new_rows))
+    blank = normalize_row([])
+    target = new_rows + [blank] * (total - len(new_rows))
+    updates, run_start = [], None
+    for i in range(total + 1):
+        changed = i < total and (existing_rows[i] if i < len(existing_rows) else blank) != target[i]
+        if changed and run_start is None:
+            run_start = i
+        elif not changed and run_start is not None:
+            updates.append({'range': f'A{first_row + run_start}', 'values': target[run_start:i]})
+            run_start = None
+    return updates
+
+def prepare_formations_sheet(spreadsheet_id):
+    """Apre (o crea) il foglio delle formazioni e ne legge il contenuto attuale (niente clear)."""
+    spreadsheet = get_gspread_client().open_by_key(spreadsheet_id)
+    try:
+        worksheet = spreadsheet.worksheet(FORMAZIONI_SHEET_NAME)
+        existing_values = worksheet.get_all_values()
+    except gspread.WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title=FORMAZIONI_SHEET_NAME, rows="100", cols="20")
+        existing_values = []
+    
+    if not existing_values or normalize_row(existing_values[0]) != HEADERS:
+        worksheet.update(range_name='A1', values=[HEADERS])
+        worksheet.format('A1:G1', {'textFormat': {'bold': True}})
+    print(f"Foglio '{FORMAZIONI_SHEET_NAME}' preparato con successo.")
+    return worksheet, existing_values[1:]
+
+def check_user_lineups(user_slug, worksheet, existing_rows, filtered_leaderboards, cache):
+    """Cerca le formazioni di un utente e aggiorna il suo foglio. Aggiorna `cache` sul posto."""
+    # Le competizioni vuote all'ultimo controllo vengono interrogate a frequenza ridotta
+    now = time.time()
+    empty_leaderboards = cache.setdefault('empty_leaderboards', {}).setdefault(user_slug, {})
+    leaderboards_to_poll = [
+        lb for lb in filtered_leaderboards
+        if now - empty_leaderboards.get(lb['slug'], 0) >= EMPTY_LEADERBOARD_POLL_MINUTES * 60
+    ]
+    print(f"Interrogo {len(leaderboards_to_poll)} competizioni per '{user_slug}' ({len(filtered_leaderboards) - len(leaderboards_to_poll)} senza formazioni saltate).")
+
+    # 4. Cerca le formazioni (batch con alias) e aggrega i dati
+    lineups_by_slug, failed_slugs = fetch_user_lineups(leaderboards_to_poll, user_slug)
+    for slug, lineups in lineups_by_slug.items():
+        if slug in failed_slugs:
+            continue
+        if lineups:
+            empty_leaderboards.pop(slug, None)
+        else:
+            empty_leaderboards[slug] = now
 
-    # 4. Cerca le formazioni e aggrega i dati
     all_formations_data = []
     for leaderboard in filtered_leaderboards:
-        print(f"-> Cerco in: \"{leaderboard['displayName']}\"")
-        lineups_data = sorare_graphql_fetch(GET_USER_LINEUPS_QUERY, {"slug": leaderboard['slug'], "userSlug": USER_SLUG})
-        lineups = lineups_data.get("data", {}).get("so5", {}).get("so5Leaderboard", {}).get("so5LineupsPaginated", {}).get("nodes", [])
-        
-        if lineups:
-            for lineup in lineups:
-                for appearance in lineup.get("so5Appearances", []):
-                    row = [
-                        leaderboard['displayName'],
-                        lineup.get('name', "Senza Nome"),
-                        appearance.get("player", {}).get("displayName"),
-                        appearance.get("anyCard", {}).get("slug"),
-                        appearance.get("anyCard", {}).get("rarityTyped"),
-                        appearance.get("position"),
-                        "Sì" if appearance.get("captain") else "No"
-                    ]
-                    all_formations_data.append(row)
-        time.sleep(0.5) # Pausa di cortesia
-
-    # 5. Scrivi i risultati sul foglio
+        if leaderboard['slug'] not in lineups_by_slug:
+            continue  # Non interrogata: nessuna formazione all'ultimo controllo
+        if leaderboard['slug'] in failed_slugs:
+            # Competizione non recuperata: si mantengono le righe già presenti nel foglio
+            print(f"-> AVVISO: formazioni non recuperate per \"{leaderboard['displayName']}\", mantengo i dati precedenti.")
+            all_formations_data.extend(row for row in existing_rows if row and row[0] == leaderboard['displayName'])
+        else:
+            all_formations_data.extend(build_formation_rows(leaderboard, lineups_by_slug[leaderboard['slug']]))
+
+    # 5. Scrivi sul foglio solo le righe cambiate
     if all_formations_data:
-        worksheet.update('A2', all_formations_data)
-        print(f"\nSUCCESSO! Trovate e scritte {len(all_formations_data)} carte schierate.")
+        write_formations(worksheet, existing_rows, all_formations_data)
+        print(f"\nSUCCESSO! Trovate {len(all_formations_data)} carte schierate per '{user_slug}'.")
     else:
-        worksheet.update('A2', [[f"Nessuna formazione trovata per l'utente '{USER_SLUG}' nelle competizioni attive."]])
-        print(f"\nNessuna formazione trovata per l'utente '{USER_SLUG}'.")
+        write_formations(worksheet, existing_rows, [[f"Nessuna formazione trovata per l'utente '{user_slug}' nelle competizioni attive."]])
+        print(f"\nNessuna formazione trovata per l'utente '{user_slug}'.")
+
+def main():
+    """Funzione principale che esegue tutto il processo."""
+    print("--- INIZIO VERIFICA FORMAZIONI SCHIERATE ---")
+    start_time = time.time()
+
+    # 1. Autenticazione e preparazione dei fogli Google (uno per galleria)
+    galleries = get_galleries()
+    if not all([SORARE_API_KEY, GSPREAD_CREDENTIALS_JSON]) or not galleries or not all(all(gallery) for gallery in galleries):
+        print("ERRORE: Uno o più segreti non sono stati configurati (API_KEY, USER_SLUG, GSPREAD_CREDENTIALS, SPREADSHEET_ID o GALLERIES).")
+        return
+
+    sheets = {}
+    for user_slug, spreadsheet_id in galleries:
+        try:
+            print(f"Autenticazione a Google Sheets per '{user_slug}'...")
+            sheets[user_slug] = prepare_formations_sheet(spreadsheet_id)
+        except Exception as e:
+            print(f"ERRORE CRITICO durante l'accesso a Google Sheets per '{user_slug}': {e}")
+    if not sheets:
+        return
+
+    # 2-3. Game Week in corso e competizioni, condivise da tutti gli utenti (cache di stato se valida)
+    state = load_state()
+    cache = state.get(STATE_KEY, {})
+    fixture, filtered_leaderboards = resolve_fixture_and_leaderboards(cache)
+    if not fixture:
+        print("Nessuna Game Week di calcio attiva trovata. Fine.")
+        state.pop(STATE_KEY, None)
+        save_state(state)
+        for worksheet, existing_rows in sheets.values():
+            write_formations(worksheet, existing_rows, [["Nessuna formazione trovata (nessuna Game Week attiva)."]])
+        return
+    if filtered_leaderboards is None:
+        print("ERRORE: impossibile recuperare le competizioni della Game Week. Fogli lasciati invariati.")
+        return
+    print(f"Trovate {len(filtered_leaderboards)} competizioni valide da controllare per {len(sheets)} utenti.")
+
+    for user_slug, (worksheet, existing_rows) in sheets.items():
+        check_user_lineups(user_slug, worksheet, existing_rows, filtered_leaderboards, cache)
+        state[STATE_KEY] = cache
+        save_state(state)
     
     end_time = time.time()
     print(f"--- ESECUZIONE COMPLETATA in {end_time - start_time:.2f} secondi ---")
 
+def write_formations(worksheet, existing_rows, new_rows):
+    """Applica al foglio solo le differenze rispetto al contenuto attuale."""
+    updates = diff_sheet_updates(existing_rows, new_rows)
+    if not updates:
+        print("Nessuna variazione nelle formazioni schierate: foglio invariato.")
+        return
+    needed_rows = max(len(existing_rows), len(new_rows)) + 1
+    if needed_rows > worksheet.row_count:
+        worksheet.add_rows(needed_rows - worksheet.row_count)
+    worksheet.batch_update(updates)
+    print(f"Aggiornate {sum(len(u['values']) for u in updates)} righe in {len(updates)} blocchi.")
+
 if __name__ == "__main__":
-    main()
+    apply_cli_options(sys.argv[1:])
+    run_stage("check_lineups", main)
@@ -3,16 +3,80 @@
 # Importazioni necessari
 import os
 import sys
-import requests
+import signal
+import importlib
 import json
 import time
-from datetime import datetime, timedelta
-import gspread
+import hashlib
+import glob
+import zlib
+import html
+import math
+import re
+import concurrent.futures
+import gzip
+import atexit
+import threading
+import cProfile
+import copy
+import heapq
+import bisect
+import queue
+import pstats
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock sul file di stato
+    fcntl = None
+from datetime import datetime, timedelta, timezone
+
+class LazyModule:
+    """Modulo importato al primo accesso: i sottocomandi che non lo usano non ne pagano l'import."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+requests = LazyModule("requests")
+gspread = LazyModule("gspread")
 
 # --- 1. CONFIGURAZIONE ---
 SORARE_API_KEY = os.environ.get("SORARE_API_KEY")
 USER_SLUG = os.environ.get("USER_SLUG")
+# Più gallerie in una sola esecuzione: JSON {"user-slug": "spreadsheet-id", ...}.
+# Se assente si usa la coppia USER_SLUG / SPREADSHEET_ID.
+GALLERIES_JSON = os.environ.get("GALLERIES")
 GSPREAD_CREDENTIALS_JSON = os.environ.get("GSPREAD_CREDENTIALS")
+# Token OAuth riusato tra i processi dello stesso ciclo finché non scade (file locale, mai committato)
+GOOGLE_TOKEN_CACHE_FILE = os.environ.get("GOOGLE_TOKEN_CACHE_FILE", ".gspread_token.json")
+GOOGLE_TOKEN_MIN_TTL_SECONDS = 300
+# Cattura/replay del traffico HTTP (Sorare, Sheets, tassi) per profilare un carico reale offline.
+# Attivabili anche da riga di comando: --capture FILE, --replay FILE, --replay-latency real|zero
+TRAFFIC_CAPTURE_FILE = os.environ.get("TRAFFIC_CAPTURE")
+TRAFFIC_REPLAY_FILE = os.environ.get("TRAFFIC_REPLAY")
+REPLAY_LATENCY = os.environ.get("REPLAY_LATENCY", "real")  # real | zero (zero disattiva anche le sleep)
+REPLAY_STATE_FILE = "state.replay.json"
+# Profilazione (--profile o PROFILE=1): statistiche cProfile e stack campionati per ogni fase
+PROFILE_ENABLED = os.environ.get("PROFILE") == "1"
+PROFILE_OUTPUT_DIR = os.environ.get("PROFILE_OUTPUT_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.005  # secondi di CPU tra due campioni SIGPROF
+PROFILE_TOP_N = 25
+# Modalità demone: (job, intervallo in minuti, priorità: a parità di orario parte prima il numero più basso).
+# Gli intervalli si possono cambiare con DAEMON_INTERVALS='{"update_sales": 30}'
+DAEMON_JOBS = [
+    ("sync_galleria", 20, 0),
+    ("update_cards", 20, 1),
+    ("update_sales", 60, 2),
+    ("check_lineups", 20, 3),
+    ("create_charts", 360, 4),
+]
+DAEMON_INTERVALS_JSON = os.environ.get("DAEMON_INTERVALS")
+DAEMON_IDLE_CHECK_SECONDS = 5
+# Host mai registrati: token nell'URL (Telegram) o scambio di credenziali (OAuth)
+TRAFFIC_EXCLUDED_HOSTS = ("api.telegram.org", "oauth2.googleapis.com", "accounts.google.com")
 SPREADSHEET_ID = os.environ.get("SPREADSHEET_ID")
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
@@ -25,8 +89,96 @@ MAX_SALES_TO_DISPLAY = 100
 MAX_SALES_FROM_API = 7
 INITIAL_SALES_FETCH_COUNT = 20
 CARD_DATA_UPDATE_INTERVAL_HOURS = 0.5
+# Prossima partita per club: salvata nello stato, scade all'orario della partita o dopo il TTL
+CLUB_FIXTURE_TTL_HOURS = 6
+CLUB_FIXTURES_STATE_KEY = "club_fixtures"
+# Punteggi SO5 / presenze ricaricati solo a partita conclusa (inizio + finestra di assestamento)
+# o comunque dopo SCORE_MAX_AGE_HOURS; l'ultimo caricamento per carta è salvato nello stato
+SCORE_SETTLE_HOURS = 3
+SCORE_MAX_AGE_HOURS = 24
+SCORE_REFRESH_STATE_KEY = "scores_refreshed_at"
+# Galleria letta con un flusso di pagine per rarità, in parallelo e sotto un unico limite di chiamate
+SORARE_RARITIES = ["limited", "rare", "super_rare", "unique"]
+CARDS_PAGE_SIZES = [100, 50]  # si parte dalla pagina più grande; se l'API la rifiuta per dimensione si scende
+# Errori GraphQL che indicano una pagina troppo pesante (complessità / dimensione): solo questi fanno scendere
+CARDS_PAGE_TOO_LARGE_PATTERN = re.compile(r"complexity|exceed|too (large|many|big)|page size|at most", re.IGNORECASE)
+# Errori transitori (rete, 5xx, timeout): stessa pagina ritentata con attese crescenti
+CARDS_PAGE_RETRIES = 3
+CARDS_PAGE_RETRY_BASE_SECONDS = 2
+SORARE_REQUESTS_PER_SECOND = float(os.environ.get("SORARE_REQUESTS_PER_SECOND", "2"))
+# Modalità shard: N worker indipendenti (es. matrix di GitHub Actions), ognuno con la sua
+# partizione deterministica di carte / coppie giocatore-rarità e il suo file di stato.
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT") or 1)
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX") or 0)
+SHARD_STATE_FILE_PREFIX = "state.shard"
+# Chiavi di stato che sono dizionari per voce (club, carta...): gli shard le aggiornano in parte,
+# quindi al merge si uniscono voce per voce invece di far vincere l'ultimo shard
+STATE_ENTRY_MERGE_KEYS = {CLUB_FIXTURES_STATE_KEY, SCORE_REFRESH_STATE_KEY}
+# Checkpoint della continuazione: ogni N elementi o T secondi, qualunque cosa arrivi prima
+CHECKPOINT_EVERY_ITEMS = 10
+CHECKPOINT_EVERY_SECONDS = 60
+# update_cards a pipeline: lettore -> fetcher in parallelo -> trasformazione -> scrittore
+CARDS_FETCH_WORKERS = int(os.environ.get("CARDS_FETCH_WORKERS") or 3)
+CARDS_PIPELINE_DEPTH = 2 * BATCH_SIZE  # carte al massimo in volo tra lettura e scrittura
+CARDS_TIME_BUDGET_SECONDS = 300
+SALES_FLUSH_EVERY_ROWS = 50
+# Lease per risorsa condivisa (foglio principale, fogli vendite) registrati nel foglio LEASE_SHEET_NAME
+# di ogni galleria: scadenza + token di fencing, così stage diversi possono girare in parallelo
+LEASES_ENABLED = os.environ.get("LEASES", "1") != "0"
+LEASE_SHEET_NAME = "Lease"
+LEASE_HEADERS = ["Risorsa", "Proprietario", "Token", "Scadenza", "Aggiornato"]
+LEASE_TTL_SECONDS = 900  # più lungo del budget di tempo di ogni stage: si rinnova a metà
+LEASE_WAIT_SECONDS = 180
+LEASE_RETRY_SECONDS = 15
+LEASE_SETTLE_SECONDS = 2  # Sheets non ha compare-and-set: si scrive, si attende e si rilegge
+LEASE_OWNER = f"{os.environ.get('GITHUB_RUN_ID', 'locale')}-{os.getpid()}-{os.urandom(3).hex()}"
+# Cronologia vendite divisa su più fogli ("Cronologia Vendite", "Cronologia Vendite 2", ...):
+# le coppie nuove vanno nel primo foglio con meno di SALES_SHEET_MAX_ROWS righe dati
+SALES_SHEET_MAX_ROWS = int(os.environ.get("SALES_SHEET_MAX_ROWS") or 1000)
 MAIN_SHEET_HEADERS = ["Slug", "Rarity", "Player Name", "Player API Slug", "Position", "U23 Eligible?", "Livello", "In Season?", "XP Corrente", "XP Prox Livello", "XP Mancanti Livello", "Sale Price (EUR)", "FLOOR CLASSIC LIMITED", "FLOOR CLASSIC RARE", "FLOOR CLASSIC SR", "FLOOR IN SEASON LIMITED", "FLOOR IN SEASON RARE", "FLOOR IN SEASON SR", "L5 So5 (%)", "L15 So5 (%)", "Avg So5 Score (3)", "Avg So5 Score (5)", "Avg So5 Score (15)", "Last 15 SO5 Scores", "Partita", "Data Prossima Partita", "Next Game API ID", "Projection Grade", "Projected Score", "Projection Reliability (%)", "Starter Odds (%)", "Fee Abilitata?", "Infortunio", "Squalifica", "Ultimo Aggiornamento", "Owner Since", "Foto URL"]
+SALES_HISTORY_HEADERS = ["Player Name", "Player API Slug", "Rarity Searched", "Sales Today (In-Season)", "Sales Today (Classic)"]
+SALES_AVG_PERIODS = [3, 7, 14, 30]
+for _p in SALES_AVG_PERIODS: 
+    SALES_HISTORY_HEADERS.extend([f"Avg Price {_p}d (In-Season)", f"Avg Price {_p}d (Classic)"])
+for _j in range(1, MAX_SALES_TO_DISPLAY + 1): 
+    SALES_HISTORY_HEADERS.extend([f"Sale {_j} Date", f"Sale {_j} Price (EUR)", f"Sale {_j} Eligibility"])
+SALES_HISTORY_HEADERS.append("Last Updated")
 CHART_SHEET_NAME = "Grafici SO5"
+# Storico valore portafoglio: JSON lines con un fotogramma completo ogni VALUATION_KEYFRAME_EVERY voci
+# e, in mezzo, solo le differenze (in centesimi) rispetto alla voce precedente della stessa galleria
+VALUATION_HISTORY_FILE = os.environ.get("VALUATION_HISTORY_FILE", "valuation_history.jsonl")
+VALUATION_KEYFRAME_EVERY = 200
+# Finestra del trend: lo storico si decodifica dall'ultimo fotogramma che la copre (offset salvati nello stato)
+VALUATION_TREND_WINDOW_SECONDS = 7 * 86400
+VALUATION_INDEX_STATE_KEY = "valuation_history_index"
+VALUATION_RARITY_FLOORS = {
+    "limited": ("FLOOR CLASSIC LIMITED", "FLOOR IN SEASON LIMITED"),
+    "rare": ("FLOOR CLASSIC RARE", "FLOOR IN SEASON RARE"),
+    "super_rare": ("FLOOR CLASSIC SR", "FLOOR IN SEASON SR"),
+}
+# Snapshot colonnari (Arrow IPC, richiede pyarrow): una partizione per esecuzione in SNAPSHOT_DIR/<tabella>/
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+SALES_SNAPSHOT_STATE_KEY = "sales_snapshot_watermarks"
+SALES_SNAPSHOT_FIELDS = [("player_slug", "string"), ("rarity", "string"), ("timestamp", "timestamp_ms"), ("price_eur", "float64"), ("eligibility", "string")]
+# Tipi delle colonne numeriche e delle date nello snapshot carte; le altre restano testo
+CARDS_SNAPSHOT_COLUMN_TYPES = {
+    **{header: "int64" for header in ["Livello", "XP Corrente", "XP Prox Livello", "XP Mancanti Livello"]},
+    **{header: "float64" for header in ["Sale Price (EUR)", "FLOOR CLASSIC LIMITED", "FLOOR CLASSIC RARE", "FLOOR CLASSIC SR",
+                                        "FLOOR IN SEASON LIMITED", "FLOOR IN SEASON RARE", "FLOOR IN SEASON SR",
+                                        "L5 So5 (%)", "L15 So5 (%)", "Avg So5 Score (3)", "Avg So5 Score (5)", "Avg So5 Score (15)",
+                                        "Projected Score", "Projection Reliability (%)", "Starter Odds (%)"]},
+    **{header: "timestamp_ms" for header in ["Data Prossima Partita", "Ultimo Aggiornamento", "Owner Since"]},
+}
+CARDS_SNAPSHOT_FIELDS = [("gallery", "string"), ("row_index", "int64")] + [(header, CARDS_SNAPSHOT_COLUMN_TYPES.get(header, "string")) for header in MAIN_SHEET_HEADERS]
+# Alert definiti dall'utente (soglie su prezzi/floor/probabilità, infortuni rientrati...) in un file JSON
+ALERT_RULES_FILE = os.environ.get("ALERT_RULES_FILE", "alert_rules.json")
+ALERTS_STATE_KEY_PREFIX = "alerts_"  # + sorgente ("cards" / "sales"): alert inviati, per non ripeterli
+ALERT_DIGEST_MAX_ITEMS = 40
+CHART_OUTPUT_DIR = os.environ.get("CHART_OUTPUT_DIR", "charts")
+CHART_OUTPUT_FORMAT = os.environ.get("CHART_OUTPUT_FORMAT", "svg")  # svg | png (png richiede Pillow)
+CHART_WIDTH, CHART_HEIGHT = 500, 300
+CONTACT_SHEET_COLUMNS = 4
+CHART_SHEET_HEADERS = ["Giocatore", "Grafico Ultimi 5 Punteggi SO5", "Nota: I grafici sono immagini generate da QuickChart.io", "Slug", "Hash"]
 GRADIENT_STOPS = {
     0: {'r': 255, 'g': 80, 'b': 80},      # Red
     40: {'r': 255, 'g': 255, 'b': 0},   # Yellow
@@ -37,9 +189,9 @@ GRADIENT_STOPS = {
 
 # --- 2. QUERY GRAPHQL ---
 ALL_CARDS_QUERY = """
-    query AllCardsFromUser($userSlug: String!, $rarities: [Rarity!], $cursor: String) {
+    query AllCardsFromUser($userSlug: String!, $rarities: [Rarity!], $cursor: String, $first: Int!) {
         user(slug: $userSlug) {
-            cards(rarities: $rarities, after: $cursor, first: 50) {
+            cards(rarities: $rarities, after: $cursor, first: $first) {
                 nodes { ... on Card { slug, rarity, ownerSince, player { ... on Player { displayName, slug, position, u23Eligible } } } }
                 pageInfo { endCursor, hasNextPage }
             }
@@ -59,20 +211,40 @@ PLAYER_TOKEN_PRICES_QUERY = """
     }
 """
 
+TOKEN_PRICE_FIELDS = "amounts { eurCents } date card { inSeasonEligible }"
+
+def build_token_prices_query(count):
+    """Costruisce la query GetPlayerTokenPricesBatch con `count` alias p0..pN-1, uno per coppia giocatore-rarità."""
+    variable_defs = ", ".join(f"$slug{i}: String!, $rarity{i}: Rarity!, $limit{i}: Int!" for i in range(count))
+    aliases = "\n".join(
+        f"            p{i}: tokenPrices(playerSlug: $slug{i}, rarity: $rarity{i}, first: $limit{i}, includePrivateSales: true) {{ {TOKEN_PRICE_FIELDS} }}"
+        for i in range(count)
+    )
+    return f"""
+    query GetPlayerTokenPricesBatch({variable_defs}) {{
+        tokens {{
+{aliases}
+        }}
+    }}"""
+
 PRICE_FRAGMENT = "liveSingleSaleOffer { receiverSide { amounts { eurCents, usdCents, gbpCents, wei, referenceCurrency } } }"
 
-OPTIMIZED_CARD_DETAILS_QUERY = f"""
-    query GetOptimizedCardDetails($cardSlug: String!) {{
+# Punteggi e presenze: richiesti solo quando il calendario dice che possono essere cambiati
+PLAYER_SCORE_FIELDS = "lastFiveSo5Appearances, lastFifteenSo5Appearances, playerGameScores(last: 15) { score }"
+
+def card_details_query(operation_name, score_fields):
+    return f"""
+    query {operation_name}($cardSlug: String!) {{
         anyCard(slug: $cardSlug) {{
             ... on Card {{
                 rarity, grade, xp, xpNeededForNextGrade, pictureUrl, inSeasonEligible, secondaryMarketFeeEnabled
                 liveSingleSaleOffer {{ receiverSide {{ amounts {{ eurCents, usdCents, gbpCents, wei, referenceCurrency }} }} }}
                 player {{
-                    slug, displayName, position, lastFiveSo5Appearances, lastFifteenSo5Appearances
-                    playerGameScores(last: 15) {{ score }}
+                    slug, displayName, position
+                    {score_fields}
                     activeInjuries {{ status, expectedEndDate }}
                     activeSuspensions {{ reason, endDate }}
-                    activeClub {{ name, upcomingGames(first: 1) {{ id, date, competition {{ displayName }}, homeTeam {{ ... on TeamInterface {{ name }} }}, awayTeam {{ ... on TeamInterface {{ name }} }} }} }}
+                    activeClub {{ slug, name }}
                     u23Eligible
                     L_ANY: lowestPriceAnyCard(rarity: limited, inSeason: false) {{ {PRICE_FRAGMENT} }}
                     L_IN: lowestPriceAnyCard(rarity: limited, inSeason: true) {{ {PRICE_FRAGMENT} }}
@@ -86,6 +258,31 @@ OPTIMIZED_CARD_DETAILS_QUERY = f"""
     }}
 """
 
+OPTIMIZED_CARD_DETAILS_QUERY = card_details_query("GetOptimizedCardDetails", PLAYER_SCORE_FIELDS)
+CARD_DETAILS_NO_SCORES_QUERY = card_details_query("GetCardDetailsNoScores", "")
+
+CLUB_FIXTURE_QUERY = """
+    query GetClubFixture($clubSlug: String!) {
+        football {
+            club(slug: $clubSlug) {
+                upcomingGames(first: 1) { id, date, competition { displayName }, homeTeam { ... on TeamInterface { name } }, awayTeam { ... on TeamInterface { name } } }
+            }
+        }
+    }
+"""
+# Variante senza il sotto-albero del giocatore, usata quando il giocatore è già in cache
+CARD_ONLY_DETAILS_QUERY = """
+    query GetCardOnlyDetails($cardSlug: String!) {
+        anyCard(slug: $cardSlug) {
+            ... on Card {
+                rarity, grade, xp, xpNeededForNextGrade, pictureUrl, inSeasonEligible, secondaryMarketFeeEnabled
+                liveSingleSaleOffer { receiverSide { amounts { eurCents, usdCents, gbpCents, wei, referenceCurrency } } }
+                player { slug }
+            }
+        }
+    }
+"""
+
 PROJECTION_QUERY = """
     query GetProjection($playerSlug: String!, $gameId: ID!) {
         football {
@@ -103,17 +300,466 @@ PROJECTION_QUERY = """
     }
 """
 
+# --- 2b. MODELLO RIGHE ---
+class SheetRow:
+    """
+    Riga compatta di un foglio: i valori stanno in una lista nell'ordine di HEADERS e
+    l'accesso per nome passa da una mappa colonna -> indice precalcolata per classe.
+    La lista `values` è direttamente quella che si scrive sul foglio.
+    """
+    __slots__ = ("values",)
+    HEADERS = []
+    INDEX = {}
+
+    def __init__(self, values=None):
+        width = len(self.HEADERS)
+        values = list(values[:width]) if values is not None else []
+        values.extend([''] * (width - len(values)))
+        self.values = values
+
+    @classmethod
+    def from_sheet_values(cls, values, headers):
+        """Costruisce la riga da valori letti dal foglio, riallineandoli se le colonne del foglio sono in ordine diverso."""
+        if headers == cls.HEADERS:
+            return cls(values)
+        row = cls()
+        for j, header in enumerate(headers):
+            idx = cls.INDEX.get(header)
+            if idx is not None and j < len(values):
+                row.values[idx] = values[j]
+        return row
+
+    def __getitem__(self, column):
+        return self.values[self.INDEX[column]]
+
+    def __setitem__(self, column, value):
+        self.values[self.INDEX[column]] = value
+
+    def get(self, column, default=''):
+        idx = self.INDEX.get(column)
+        return self.values[idx] if idx is not None else default
+
+    def copy(self):
+        return type(self)(self.values)
+
+def make_row_class(name, headers):
+    return type(name, (SheetRow,), {"__slots__": (), "HEADERS": list(headers), "INDEX": {h: i for i, h in enumerate(headers)}})
+
+MainRow = make_row_class("MainRow", MAIN_SHEET_HEADERS)
+SalesRow = make_row_class("SalesRow", SALES_HISTORY_HEADERS)
+# Indici (data, prezzo, eleggibilità) delle colonne "Sale N", precalcolati una volta
+SALE_COLUMN_INDEXES = [
+    (SalesRow.INDEX[f"Sale {j} Date"], SalesRow.INDEX[f"Sale {j} Price (EUR)"], SalesRow.INDEX[f"Sale {j} Eligibility"])
+    for j in range(1, MAX_SALES_TO_DISPLAY + 1)
+]
+
+# Cache condivise tra le gallerie nella stessa esecuzione
+PLAYER_INFO_CACHE = {}   # player slug -> sotto-albero player (statistiche, floor, club)
+PROJECTION_CACHE = {}    # (player slug, game id) -> proiezione
+TOKEN_PRICES_CACHE = {}  # (player slug, rarity) -> (limite richiesto, vendite)
+CLUB_FIXTURE_CACHE = {}  # club slug -> {"Partita", "Data Prossima Partita", "Next Game API ID", "expires"}
+SCORES_REFRESHED_AT = {} # card slug -> timestamp dell'ultimo caricamento dei punteggi nella riga
+
 # --- 3. FUNZIONI HELPER ---
-def load_state():
+def get_galleries():
+    """Ritorna la lista di (user_slug, spreadsheet_id) da gestire."""
+    if not GALLERIES_JSON:
+        return [(USER_SLUG, SPREADSHEET_ID)]
+    try:
+        return list(json.loads(GALLERIES_JSON).items())
+    except (json.JSONDecodeError, AttributeError) as e:
+        print(f"ERRORE: configurazione GALLERIES non valida: {e}")
+        return []
+
+def gallery_state_key(base_key, user_slug):
+    """
+    Chiave di stato per galleria (e per shard): la galleria di USER_SLUG senza shard
+    mantiene le chiavi storiche.
+    """
+    key = base_key if user_slug == USER_SLUG else f"{base_key}::{user_slug}"
+    return f"{key}#shard{SHARD_INDEX}of{SHARD_COUNT}" if SHARD_COUNT > 1 else key
+
+def gallery_label(user_slug):
+    """Suffisso per log e notifiche, solo in modalità multi-galleria o shard."""
+    label = f" [{user_slug}]" if GALLERIES_JSON else ""
+    return label + (f" [shard {SHARD_INDEX + 1}/{SHARD_COUNT}]" if SHARD_COUNT > 1 else "")
+
+def shard_of(key, shard_count):
+    """Partizione deterministica di una chiave (crc32: stabile tra processi, a differenza di hash())."""
+    return zlib.crc32(key.encode('utf-8')) % shard_count
+
+def in_current_shard(key):
+    return SHARD_COUNT <= 1 or shard_of(key, SHARD_COUNT) == SHARD_INDEX
+
+_gspread_client = None
+
+def load_cached_google_token(account_email):
+    """Token OAuth salvato da un processo precedente, se è dello stesso account e non sta per scadere."""
+    try:
+        with open(GOOGLE_TOKEN_CACHE_FILE, "r") as f:
+            cached = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if cached.get("account") != account_email or cached.get("expiry", 0) - time.time() < GOOGLE_TOKEN_MIN_TTL_SECONDS:
+        return None
+    return cached
+
+def save_cached_google_token(account_email, token, expiry):
+    try:
+        fd = os.open(GOOGLE_TOKEN_CACHE_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"account": account_email, "token": token, "expiry": expiry}, f)
+    except OSError as e:
+        print(f"AVVISO: impossibile salvare il token Google in cache: {e}")
+
+def get_gspread_client():
+    """
+    Client gspread autenticato, creato una sola volta per processo. Il token di accesso
+    viene preso dalla cache su disco se ancora valido, altrimenti richiesto e salvato.
+    """
+    global _gspread_client
+    if _gspread_client is None:
+        _gspread_client = new_gspread_client()
+    return _gspread_client
+
+def new_gspread_client():
+    """
+    Nuovo client gspread con una propria sessione HTTP. La sessione (requests.Session) non è
+    thread-safe: un thread che lavora in parallelo al client condiviso ne usa uno suo.
+    """
+    if TRAFFIC_REPLAY_FILE:
+        # In replay le risposte arrivano dall'archivio: nessuna credenziale reale
+        from google.auth.credentials import AnonymousCredentials
+        return gspread.authorize(AnonymousCredentials())
+    from google.oauth2.service_account import Credentials
+    from google.auth.transport.requests import Request
+    credentials = Credentials.from_service_account_info(json.loads(GSPREAD_CREDENTIALS_JSON), scopes=gspread.auth.DEFAULT_SCOPES)
+    cached = load_cached_google_token(credentials.service_account_email)
+    if cached:
+        # google-auth lavora con datetime UTC naive
+        credentials.token = cached["token"]
+        credentials.expiry = datetime.fromtimestamp(cached["expiry"], timezone.utc).replace(tzinfo=None)
+    else:
+        credentials.refresh(Request())
+        expiry = (credentials.expiry - datetime(1970, 1, 1)).total_seconds()
+        save_cached_google_token(credentials.service_account_email, credentials.token, expiry)
+    return gspread.authorize(credentials)
+
+def shard_state_file():
+    return f"{SHARD_STATE_FILE_PREFIX}{SHARD_INDEX}of{SHARD_COUNT}.json"
+
+def _read_state_file(path):
     try:
-        with open(STATE_FILE, "r") as f: 
+        with open(path, "r") as f: 
             return json.load(f)
     except (FileNotFoundError, json.JSONDecodeError): 
-        return {}
+        return None
 
-def save_state(state_data):
-    with open(STATE_FILE, "w") as f: 
+_state_memory = None  # In modalità demone lo stato vive in memoria (e viene comunque salvato su disco)
+
+class StateDict(dict):
+    """Stato letto da disco, con la copia di quanto letto: al salvataggio si scrivono solo le chiavi cambiate."""
+    def __init__(self, data):
+        super().__init__(data)
+        self.baseline = copy.deepcopy(data)
+
+def load_state():
+    if _state_memory is not None:
+        return copy.deepcopy(_state_memory)
+    # In modalità shard si riparte dal file dello shard, se esiste, altrimenti dallo stato condiviso
+    state_data = _read_state_file(shard_state_file()) if SHARD_COUNT > 1 else None
+    if state_data is not None:
+        return StateDict(state_data)
+    state_data = _read_state_file(STATE_FILE) or {}
+    # Il file dello shard non esiste ancora: il primo salvataggio deve scriverlo per intero
+    return StateDict(state_data) if SHARD_COUNT <= 1 else state_data
+
+def state_file_lock(path):
+    """Lock esclusivo (flock) sul file di stato, rilasciato dal sistema anche se il processo muore."""
+    lock_file = open(f"{path}.lock", "w")
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def write_state_file(path, state_data):
+    """Scrittura atomica: un crash a metà non lascia mai un file di stato troncato. Va chiamata sotto state_file_lock."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f: 
         json.dump(state_data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def save_state(state_data):
+    global _state_memory
+    if _state_memory is not None:
+        _state_memory = copy.deepcopy(state_data)
+    path = shard_state_file() if SHARD_COUNT > 1 else STATE_FILE
+    # Stage in parallelo sulla stessa copia: sotto lock si rilegge il file e si applicano solo le
+    # chiavi che questo processo ha cambiato o rimosso, senza cancellare quelle scritte dagli altri
+    with state_file_lock(path):
+        baseline = getattr(state_data, "baseline", None)
+        if baseline is None:
+            merged = state_data
+        else:
+            merged = _read_state_file(path) or {}
+            for key in baseline.keys() - state_data.keys():
+                merged.pop(key, None)
+            for key, value in state_data.items():
+                if key not in baseline or baseline[key] != value:
+                    merged[key] = value
+        write_state_file(path, merged)
+    if baseline is not None:
+        state_data.baseline = copy.deepcopy(dict(state_data))
+
+class Checkpointer:
+    """
+    Salva periodicamente (ogni CHECKPOINT_EVERY_ITEMS elementi o CHECKPOINT_EVERY_SECONDS
+    secondi) la continuazione di uno stage. Tutto ciò che sta in `continuation_data`,
+    compreso un eventuale buffer di scritture, finisce nello stesso salvataggio atomico.
+    """
+    def __init__(self, state, state_key, continuation_data):
+        self.state, self.state_key, self.continuation_data = state, state_key, continuation_data
+        self.last_save, self.items_since_save = time.time(), 0
+
+    def save(self, next_index):
+        self.continuation_data['last_index'] = next_index
+        self.state[self.state_key] = self.continuation_data
+        save_state(self.state)
+        self.last_save, self.items_since_save = time.time(), 0
+
+    def tick(self, next_index):
+        """Da chiamare prima di ogni elemento: `next_index` è il primo elemento non ancora completato."""
+        if self.items_since_save >= CHECKPOINT_EVERY_ITEMS or time.time() - self.last_save >= CHECKPOINT_EVERY_SECONDS:
+            self.save(next_index)
+        self.items_since_save += 1
+
+    def clear(self):
+        if self.state_key in self.state: 
+            del self.state[self.state_key]
+        save_state(self.state)
+
+def handle_termination(signum, frame):
+    """SIGTERM (runner cancellato/ucciso) diventa SystemExit, così gli stage salvano il checkpoint."""
+    raise SystemExit(128 + signum)
+
+class LeaseBusy(Exception):
+    """La risorsa è tenuta da un altro processo oltre LEASE_WAIT_SECONDS."""
+
+class LeaseLost(Exception):
+    """Il lease è scaduto ed è stato preso da un altro processo: le scritture vanno interrotte."""
+
+class SheetLease:
+    """
+    Lease su una risorsa condivisa di una galleria, registrato come riga del foglio
+    LEASE_SHEET_NAME (risorsa, proprietario, token, scadenza). Sheets non ha compare-and-set:
+    si scrive la riga e la si rilegge subito e di nuovo dopo LEASE_SETTLE_SECONDS; vince chi
+    ritrova sé stesso (proprietario e token) in entrambe le letture. Il token di fencing cresce
+    a ogni acquisizione e `check()` va chiamato prima di ogni scrittura: rilegge sempre il
+    lease, così un processo rimasto fermo oltre la scadenza scopre di aver perso il lease
+    invece di scrivere sopra al nuovo titolare.
+    """
+    def __init__(self, spreadsheet, resource):
+        self.spreadsheet, self.resource, self.ttl = spreadsheet, resource, LEASE_TTL_SECONDS
+        self.worksheet, self.token, self.expires, self.row = None, None, 0, None
+
+    def _open(self):
+        if self.worksheet is None:
+            try:
+                self.worksheet = self.spreadsheet.worksheet(LEASE_SHEET_NAME)
+            except gspread.WorksheetNotFound:
+                try:
+                    self.worksheet = self.spreadsheet.add_worksheet(title=LEASE_SHEET_NAME, rows=20, cols=len(LEASE_HEADERS))
+                    self.worksheet.update(range_name='A1', values=[LEASE_HEADERS])
+                except gspread.exceptions.APIError:
+                    # Creato nel frattempo da un altro processo
+                    self.worksheet = self.spreadsheet.worksheet(LEASE_SHEET_NAME)
+        return self.worksheet
+
+    def _read(self):
+        """Ritorna (riga, proprietario, token, scadenza) della risorsa; riga None se non è mai stata registrata."""
+        for row_index, values in enumerate(self._open().get_all_values()[1:], start=2):
+            if values and values[0] == self.resource:
+                self.row = row_index
+                return (row_index,) + self._parse(values)
+        return None, "", 0, 0.0
+
+    def _read_own(self):
+        """Come _read, ma leggendo solo la riga già nota della risorsa (un round trip di una riga per ogni fencing)."""
+        if self.row is not None:
+            values = self._open().row_values(self.row)
+            if values and values[0] == self.resource:
+                return (self.row,) + self._parse(values)
+        # Riga spostata o cancellata a mano: si cerca di nuovo in tutto il foglio
+        return self._read()
+
+    @staticmethod
+    def _parse(values):
+        values = values + [''] * (len(LEASE_HEADERS) - len(values))
+        try:
+            return values[1], int(values[2] or 0), float(values[3] or 0)
+        except ValueError:
+            return values[1], 0, 0.0
+
+    def _write(self, row_index, owner, token, expires):
+        values = [[self.resource, owner, token, expires, datetime.now().strftime('%Y-%m-%d %H:%M:%S')]]
+        if row_index is None:
+            self.worksheet.append_rows(values, value_input_option='RAW')
+        else:
+            self.worksheet.update(range_name=f'A{row_index}', values=values, value_input_option='RAW')
+
+    def acquire(self):
+        deadline = time.time() + LEASE_WAIT_SECONDS
+        while True:
+            row_index, owner, token, expires = self._read()
+            now = time.time()
+            if owner and owner != LEASE_OWNER and expires > now:
+                if now + LEASE_RETRY_SECONDS > deadline:
+                    raise LeaseBusy(f"'{self.resource}' tenuto da {owner} fino alle {datetime.fromtimestamp(expires).strftime('%H:%M:%S')}")
+                print(f"Lease '{self.resource}' occupato da {owner}: riprovo tra {LEASE_RETRY_SECONDS}s...")
+                time.sleep(LEASE_RETRY_SECONDS)
+                continue
+            self._write(row_index, LEASE_OWNER, token + 1, now + self.ttl)
+            if self._holds(token + 1):
+                # La scrittura è visibile: dopo l'assestamento deve esserlo ancora, se nessuno l'ha sovrascritta
+                time.sleep(LEASE_SETTLE_SECONDS)
+                if self._holds(token + 1):
+                    print(f"Lease '{self.resource}' acquisito (token {self.token}).")
+                    return self
+            # Un altro processo ha scritto dopo di noi: si riprova come se fosse occupato
+
+    def _holds(self, token):
+        """Rilegge il lease: True (aggiornando token e scadenza) se è ancora nostro con il token indicato."""
+        _, owner, read_token, expires = self._read_own()
+        if owner == LEASE_OWNER and read_token == token:
+            self.token, self.expires = read_token, expires
+            return True
+        return False
+
+    def check(self):
+        """Fencing prima di una scrittura: il token viene sempre riletto (dalla sola riga del lease); oltre metà della durata il lease viene anche rinnovato."""
+        row_index, owner, token, _ = self._read_own()
+        if owner != LEASE_OWNER or token != self.token:
+            raise LeaseLost(f"'{self.resource}' ora è di {owner or 'nessuno'} (token {token}, il nostro era {self.token})")
+        if time.time() >= self.expires - self.ttl / 2:
+            self.expires = time.time() + self.ttl
+            self._write(row_index, LEASE_OWNER, self.token, self.expires)
+
+    def release(self):
+        try:
+            row_index, owner, token, _ = self._read_own()
+            if owner == LEASE_OWNER and token == self.token:
+                # Il token resta: la prossima acquisizione lo incrementa
+                self._write(row_index, "", token, 0)
+        except Exception as e:
+            print(f"Errore rilascio lease '{self.resource}' (scadrà da solo): {e}")
+
+ACTIVE_LEASES = {}
+
+def fence(resource):
+    """Da chiamare prima di scrivere su una risorsa: verifica il lease tenuto su di essa (se i lease sono attivi)."""
+    lease = ACTIVE_LEASES.get(resource)
+    if lease is not None:
+        lease.check()
+
+def with_leases(spreadsheet_id, resources, func, *args):
+    """
+    Esegue func(*args) tenendo i lease delle risorse indicate sullo spreadsheet della galleria.
+    Se una risorsa resta occupata la galleria viene saltata (ritorna True, come per un errore
+    GSheets); se un lease viene perso durante le scritture lo stage si ferma (ritorna False).
+    """
+    if not LEASES_ENABLED:
+        return func(*args)
+    leases = []
+    try:
+        try:
+            spreadsheet = get_gspread_client().open_by_key(spreadsheet_id)
+            # Ordine fisso di acquisizione: due stage che chiedono le stesse risorse non si bloccano a vicenda
+            for resource in sorted(resources):
+                leases.append(SheetLease(spreadsheet, resource).acquire())
+                ACTIVE_LEASES[resource] = leases[-1]
+        except LeaseBusy as e:
+            print(f"Risorsa occupata: {e}. Salto la galleria.")
+            return True
+        except Exception as e:
+            print(f"ERRORE CRITICO GSheets (lease): {e}")
+            return True
+        return func(*args)
+    except LeaseLost as e:
+        print(f"🚨 Lease perso: {e}. Interrompo lo stage (il checkpoint è salvato).")
+        return False
+    finally:
+        for lease in reversed(leases):
+            ACTIVE_LEASES.pop(lease.resource, None)
+            lease.release()
+
+def merge_state_entries(base, shard_values):
+    """
+    Unisce voce per voce un dizionario di stato modificato da più shard: vince lo shard che ha
+    cambiato la voce rispetto alla base; una voce rimossa da uno shard sparisce solo se nessun
+    altro shard l'ha aggiornata.
+    """
+    base = base if isinstance(base, dict) else {}
+    merged = dict(base)
+    changed = {}
+    for value in shard_values:
+        value = value if isinstance(value, dict) else {}
+        for entry in base.keys() - value.keys():
+            merged.pop(entry, None)
+        for entry, entry_value in value.items():
+            if entry_value != base.get(entry):
+                changed[entry] = entry_value
+    merged.update(changed)
+    return merged
+
+def merge_alert_states(base, shard_values):
+    """Stato degli alert (impronta delle regole e alert inviati per entità): l'impronta viene dallo shard che l'ha cambiata, gli inviati si uniscono per entità."""
+    base = base if isinstance(base, dict) else {}
+    shard_values = [value if isinstance(value, dict) else {} for value in shard_values]
+    rules = next((value.get("rules") for value in shard_values if value.get("rules") != base.get("rules")), base.get("rules"))
+    return {"rules": rules, "sent": merge_state_entries(base.get("sent"), [value.get("sent") for value in shard_values])}
+
+def state_key_merger(key):
+    """Funzione di merge per voce di una chiave di stato, o None se per la chiave vince lo shard che l'ha cambiata."""
+    if key in STATE_ENTRY_MERGE_KEYS:
+        return merge_state_entries
+    if key.startswith(ALERTS_STATE_KEY_PREFIX):
+        return merge_alert_states
+    return None
+
+def merge_shard_states():
+    """
+    Ricompone state.json a partire dai file di stato degli shard: per ogni chiave vince lo
+    shard che l'ha modificata (o rimossa) rispetto allo stato condiviso; le chiavi in
+    STATE_ENTRY_MERGE_KEYS e gli alert si uniscono voce per voce. I file degli shard vengono poi eliminati.
+    """
+    shard_files = sorted(glob.glob(f"{SHARD_STATE_FILE_PREFIX}*.json"))
+    with state_file_lock(STATE_FILE):
+        base = _read_state_file(STATE_FILE) or {}
+        merged = dict(base)
+        shard_states = []
+        for path in shard_files:
+            shard_state = _read_state_file(path)
+            if shard_state is None:
+                print(f"AVVISO: file di stato {path} illeggibile, ignorato.")
+                continue
+            shard_states.append(shard_state)
+            for key in base.keys() | shard_state.keys():
+                if state_key_merger(key) is not None:
+                    continue
+                if key not in shard_state:
+                    merged.pop(key, None)
+                elif shard_state[key] != base.get(key):
+                    merged[key] = shard_state[key]
+        if shard_states:
+            for key in set(base).union(*shard_states):
+                merger = state_key_merger(key)
+                if merger is not None:
+                    merged[key] = merger(base.get(key), [shard_state.get(key) for shard_state in shard_states])
+        write_state_file(STATE_FILE, merged)
+    for path in shard_files:
+        os.remove(path)
+    print(f"Stato unificato da {len(shard_files)} shard in {STATE_FILE}.")
 
 def sorare_graphql_fetch(query, variables={}):
     payload = {"query": query, "variables": variables}
@@ -139,6 +785,72 @@ def sorare_graphql_fetch(query, variables={}):
         print(f"Errore di rete generico: {e}")
         return None
 
+class RateLimiter:
+    """Limite di chiamate condiviso tra thread: due chiamate sono distanziate di almeno 1/per_second secondi."""
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+SORARE_RATE_LIMITER = RateLimiter(SORARE_REQUESTS_PER_SECOND)
+def page_too_large(data):
+    """True se la risposta GraphQL rifiuta la pagina per complessità o dimensione (non per un errore transitorio)."""
+    errors = (data or {}).get("errors") or []
+    return any(CARDS_PAGE_TOO_LARGE_PATTERN.search(str(error.get("message", "") if isinstance(error, dict) else error)) for error in errors)
+
+def fetch_user_cards_by_rarity(user_slug, rarity):
+    """
+    Tutte le carte di una rarità, pagina per pagina. Ogni flusso parte dalla pagina più grande e
+    scende solo se l'API la rifiuta per dimensione; gli errori transitori ritentano la stessa
+    pagina. Ritorna None se il flusso si interrompe.
+    """
+    cards, cursor, page_size, attempt = [], None, CARDS_PAGE_SIZES[0], 0
+    while True:
+        SORARE_RATE_LIMITER.wait()
+        variables = {"userSlug": user_slug, "rarities": [rarity], "cursor": cursor, "first": page_size}
+        data = sorare_graphql_fetch(ALL_CARDS_QUERY, variables)
+        cards_data = ((data or {}).get("data") or {}).get("user", {}) or {}
+        cards_data = cards_data.get("cards")
+        if not data or "errors" in data or not cards_data:
+            smaller = [size for size in CARDS_PAGE_SIZES if size < page_size]
+            if page_too_large(data) and smaller:
+                # Pagina rifiutata: si riprova lo stesso cursore con la dimensione successiva
+                print(f"Pagina da {page_size} non accettata per {rarity}: riprovo con {smaller[0]}.")
+                page_size, attempt = smaller[0], 0
+                continue
+            if attempt < CARDS_PAGE_RETRIES:
+                attempt += 1
+                delay = CARDS_PAGE_RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+                print(f"Pagina carte {rarity} non ricevuta: tentativo {attempt}/{CARDS_PAGE_RETRIES} tra {delay}s.")
+                time.sleep(delay)
+                continue
+            print(f"ERRORE: lettura carte {rarity} interrotta.")
+            return None
+        attempt = 0
+        cards.extend(cards_data.get("nodes", []))
+        page_info = cards_data.get("pageInfo", {})
+        if not page_info.get("hasNextPage"):
+            return cards
+        cursor = page_info.get("endCursor")
+
+def fetch_all_user_cards(user_slug):
+    """Galleria completa con un flusso per rarità in parallelo. Ritorna None se un flusso fallisce."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(SORARE_RARITIES)) as executor:
+        results = list(executor.map(lambda rarity: fetch_user_cards_by_rarity(user_slug, rarity), SORARE_RARITIES))
+    if any(result is None for result in results):
+        return None
+    for rarity, result in zip(SORARE_RARITIES, results):
+        print(f"  {rarity}: {len(result)} carte")
+    return [card for result in results for card in result]
+
 def send_telegram_notification(text):
     if not all([TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID]): 
         return
@@ -194,10 +906,170 @@ def fetch_projection(player_slug, game_id):
     if not player_slug or not game_id: 
         return None
     clean_game_id = str(game_id).replace("Game:", "")
+    cache_key = (player_slug, clean_game_id)
+    if cache_key in PROJECTION_CACHE:
+        return PROJECTION_CACHE[cache_key]
+    SORARE_RATE_LIMITER.wait()
     data = sorare_graphql_fetch(PROJECTION_QUERY, {"playerSlug": player_slug, "gameId": clean_game_id})
-    return data.get("data", {}).get("football", {}).get("player", {}).get("playerGameScore") if data else None
+    projection = data.get("data", {}).get("football", {}).get("player", {}).get("playerGameScore") if data else None
+    if data:
+        PROJECTION_CACHE[cache_key] = projection
+    return projection
+
+def fixture_columns(club_name, game):
+    """Valori delle colonne Partita / Data Prossima Partita / Next Game API ID per la prossima partita di un club."""
+    if not game:
+        return {"Partita": "Nessuna partita", "Data Prossima Partita": "", "Next Game API ID": ""}
+    if not game.get('date'):
+        return {"Partita": "Data non disp.", "Data Prossima Partita": "", "Next Game API ID": ""}
+    game_date = datetime.fromisoformat(game['date'].replace("Z", "+00:00")).strftime('%d-%m-%y %H:%M')
+    home, away, comp = (game.get("homeTeam") or {}).get("name", ""), (game.get("awayTeam") or {}).get("name", ""), (game.get("competition") or {}).get("displayName", "")
+    partita = f"🏠 vs {away} [{comp}]" if home == club_name else f"✈️ vs {home} [{comp}]"
+    return {"Partita": partita, "Data Prossima Partita": game_date, "Next Game API ID": game.get("id", "")}
+
+def fetch_club_fixture(club):
+    """
+    Prossima partita del club (colonne già formattate), scaricata una volta per club e
+    riusata da tutti i suoi giocatori finché non inizia la partita o scade il TTL.
+    Ritorna None se l'API non risponde e non c'è nulla in cache.
+    """
+    if not club or not club.get("slug"):
+        return fixture_columns(None, None)
+    club_slug, now = club["slug"], time.time()
+    cached = CLUB_FIXTURE_CACHE.get(club_slug)
+    if cached and cached["expires"] > now:
+        return cached
+    SORARE_RATE_LIMITER.wait()
+    data = sorare_graphql_fetch(CLUB_FIXTURE_QUERY, {"clubSlug": club_slug})
+    club_data = ((data or {}).get("data") or {}).get("football", {}).get("club") if data else None
+    if not data or "errors" in data or club_data is None:
+        return cached
+    games = club_data.get("upcomingGames") or []
+    game = games[0] if games else None
+    entry = fixture_columns(club.get("name"), game)
+    expires = now + CLUB_FIXTURE_TTL_HOURS * 3600
+    if game and game.get("date"):
+        # Quando la partita inizia la "prossima" cambia: la voce scade lì
+        expires = min(expires, datetime.fromisoformat(game["date"].replace("Z", "+00:00")).timestamp())
+    entry["expires"] = expires
+    CLUB_FIXTURE_CACHE[club_slug] = entry
+    return entry
+
+def cached_player_info(player_slug, include_scores):
+    player_info = PLAYER_INFO_CACHE.get(player_slug) if player_slug else None
+    if player_info and include_scores and "playerGameScores" not in player_info:
+        return None
+    return player_info
+
+def fetch_card_details(card_slug, player_slug=None, include_scores=True):
+    """
+    Dettagli di una carta. Il sotto-albero del giocatore (statistiche, floor, club) è
+    condiviso tra tutte le carte dello stesso giocatore, anche di gallerie diverse:
+    se è già in cache si scaricano solo i campi della carta. Con include_scores=False
+    punteggi e presenze non vengono richiesti.
+    Ritorna (card_details, player_info) oppure (None, None).
+    """
+    if cached_player_info(player_slug, include_scores):
+        SORARE_RATE_LIMITER.wait()
+        details_data = sorare_graphql_fetch(CARD_ONLY_DETAILS_QUERY, {"cardSlug": card_slug})
+        card_details = (details_data or {}).get("data", {}).get("anyCard")
+        if not card_details:
+            return None, None
+        card_player_info = cached_player_info((card_details.get("player") or {}).get("slug"), include_scores)
+        if card_player_info:
+            return card_details, card_player_info
+    query = OPTIMIZED_CARD_DETAILS_QUERY if include_scores else CARD_DETAILS_NO_SCORES_QUERY
+    SORARE_RATE_LIMITER.wait()
+    details_data = sorare_graphql_fetch(query, {"cardSlug": card_slug})
+    card_details = (details_data or {}).get("data", {}).get("anyCard")
+    if not card_details:
+        return None, None
+    player_info = card_details.get("player")
+    if player_info and player_info.get("slug"):
+        PLAYER_INFO_CACHE[player_info["slug"]] = player_info
+    return card_details, player_info
+
+def parse_fixture_time(value):
+    """Timestamp di "Data Prossima Partita" (formato '%d-%m-%y %H:%M', UTC) o None."""
+    try:
+        return datetime.strptime(value, '%d-%m-%y %H:%M').replace(tzinfo=timezone.utc).timestamp()
+    except (ValueError, TypeError):
+        return None
+
+def scores_need_refresh(record, refreshed_at, now):
+    """
+    I punteggi cambiano solo dopo che il club ha giocato: vanno ricaricati se la partita
+    salvata nella riga si è conclusa dopo l'ultimo caricamento, se la riga non è mai stata
+    aggiornata o se il caricamento è più vecchio di SCORE_MAX_AGE_HOURS.
+    """
+    if refreshed_at is None or not record["Ultimo Aggiornamento"] or now - refreshed_at > SCORE_MAX_AGE_HOURS * 3600:
+        return True
+    kickoff = parse_fixture_time(record["Data Prossima Partita"])
+    if kickoff is None:
+        return False
+    settled = kickoff + SCORE_SETTLE_HOURS * 3600
+    return refreshed_at < settled <= now
+
+def fetch_token_prices(player_slug, rarity, limit):
+    """
+    Ultime vendite (prezzo già in EUR) di una coppia giocatore-rarità, condivise tra le
+    gallerie: se la coppia è già stata scaricata con un limite sufficiente non si richiama l'API.
+    Ritorna None in caso di errore.
+    """
+    cached = TOKEN_PRICES_CACHE.get((player_slug, rarity))
+    if cached and cached[0] >= limit:
+        return cached[1][:limit]
+    SORARE_RATE_LIMITER.wait()
+    api_data = sorare_graphql_fetch(PLAYER_TOKEN_PRICES_QUERY, {
+        "playerSlug": player_slug, 
+        "rarity": rarity, 
+        "limit": limit
+    })
+    if not api_data or not api_data.get("data") or api_data.get("errors"):
+        return None
+    sales = parse_token_prices(api_data["data"].get("tokens", {}).get("tokenPrices", []))
+    TOKEN_PRICES_CACHE[(player_slug, rarity)] = (limit, sales)
+    return sales
+
+def parse_token_prices(token_prices):
+    sales = []
+    for sale in token_prices or []:
+        # CORREZIONE CRITICA BUG CACHE: SALVA SEMPRE IL PREZZO GIÀ CONVERTITO
+        sales.append({
+            "timestamp": datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%SZ").timestamp() * 1000, 
+            "price": sale['amounts']['eurCents'] / 100,  # SALVATO GIÀ IN EUR NELLA CACHE
+            "seasonEligibility": "IN_SEASON" if sale['card']['inSeasonEligible'] else "CLASSIC"
+        })
+    return sales
+
+def prefetch_token_prices(requests_to_fetch):
+    """
+    Scarica in un solo documento GraphQL le vendite di più coppie (player slug, rarity, limit)
+    e le mette in TOKEN_PRICES_CACHE. Un errore su un alias (path ["tokens", "pN"]) invalida
+    solo quella coppia, che resta fuori dalla cache e verrà richiesta singolarmente da fetch_token_prices.
+    """
+    pending = [(slug, rarity, limit) for slug, rarity, limit in requests_to_fetch
+               if not (TOKEN_PRICES_CACHE.get((slug, rarity)) and TOKEN_PRICES_CACHE[(slug, rarity)][0] >= limit)]
+    if len(pending) < 2:
+        return
+    variables = {}
+    for i, (slug, rarity, limit) in enumerate(pending):
+        variables.update({f"slug{i}": slug, f"rarity{i}": rarity, f"limit{i}": limit})
+    SORARE_RATE_LIMITER.wait()
+    api_data = sorare_graphql_fetch(build_token_prices_query(len(pending)), variables)
+    tokens = ((api_data or {}).get("data") or {}).get("tokens") or {}
+    failed_aliases = {err["path"][1] for err in (api_data or {}).get("errors", []) if len(err.get("path") or []) > 1}
+    failed = 0
+    for i, (slug, rarity, limit) in enumerate(pending):
+        alias = f"p{i}"
+        if alias in failed_aliases or tokens.get(alias) is None:
+            failed += 1
+            continue
+        TOKEN_PRICES_CACHE[(slug, rarity)] = (limit, parse_token_prices(tokens[alias]))
+    print(f"  📦 Vendite di {len(pending)} coppie in una richiesta ({failed} da riprovare singolarmente)")
 
-def build_updated_card_row(original_record, card_details, player_info, projection_data, rates):
+def build_updated_card_row(original_record, card_details, player_info, projection_data, rates, fixture):
+    """Ritorna la lista dei valori aggiornati (ordine MAIN_SHEET_HEADERS) partendo da una MainRow. fixture viene da fetch_club_fixture."""
     record = original_record.copy()
     if not player_info: 
         player_info = card_details.get("player", {})
@@ -260,20 +1132,10 @@ def build_updated_card_row(original_record, card_details, player_info, projectio
             record["Squalifica"] = f"{suspensions[0].get('reason', 'Squalificato')} fino al {end_date}"
     else: 
         record["Squalifica"] = ""
-    club = player_info.get("activeClub")
-    if club and club.get("upcomingGames"):
-        game = club["upcomingGames"][0]
-        if game and game.get('date'):
-            game_date = datetime.fromisoformat(game['date'].replace("Z", "+00:00")).strftime('%d-%m-%y %H:%M')
-            home, away, comp = game.get("homeTeam", {}).get("name", ""), game.get("awayTeam", {}).get("name", ""), game.get("competition", {}).get("displayName", "")
-            record["Data Prossima Partita"], record["Next Game API ID"] = game_date, game.get("id", "")
-            record["Partita"] = f"🏠 vs {away} [{comp}]" if home == club.get("name") else f"✈️ vs {home} [{comp}]"
-        else: 
-            record["Partita"], record["Data Prossima Partita"], record["Next Game API ID"] = "Data non disp.", "", ""
-    else: 
-        record["Partita"], record["Data Prossima Partita"], record["Next Game API ID"] = "Nessuna partita", "", ""
+    if fixture:  # Senza risposta dall'API si lasciano i valori già presenti
+        record["Partita"], record["Data Prossima Partita"], record["Next Game API ID"] = fixture["Partita"], fixture["Data Prossima Partita"], fixture["Next Game API ID"]
     record["Ultimo Aggiornamento"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    return [record.get(header, '') for header in MAIN_SHEET_HEADERS]
+    return record.values
 
 def parse_price(price_val):
     if price_val is None or price_val == '':
@@ -395,15 +1257,15 @@ def format_price_as_string(price):
     except (ValueError, TypeError):
         return str(price)
 
-def build_sales_history_row(name, slug, rarity, all_sales, headers):
+def build_sales_history_row(name, slug, rarity, all_sales):
+    """Ritorna la lista dei valori della riga vendite (ordine SALES_HISTORY_HEADERS)."""
     now_ms = time.time() * 1000
-    today_start_dt = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-    out_row_map = {"Player Name": name, "Player API Slug": slug, "Rarity Searched": rarity}
-    sales_today_in_season = len([s for s in all_sales if datetime.fromtimestamp(s['timestamp']/1000) >= today_start_dt and s['seasonEligibility'] == "IN_SEASON"])
-    sales_today_classic = len([s for s in all_sales if datetime.fromtimestamp(s['timestamp']/1000) >= today_start_dt and s['seasonEligibility'] != "IN_SEASON"])
-    out_row_map["Sales Today (In-Season)"] = sales_today_in_season
-    out_row_map["Sales Today (Classic)"] = sales_today_classic
-    for p in [3, 7, 14, 30]:
+    today_start_ms = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp() * 1000
+    row = SalesRow()
+    row["Player Name"], row["Player API Slug"], row["Rarity Searched"] = name, slug, rarity
+    row["Sales Today (In-Season)"] = sum(1 for s in all_sales if s['timestamp'] >= today_start_ms and s['seasonEligibility'] == "IN_SEASON")
+    row["Sales Today (Classic)"] = sum(1 for s in all_sales if s['timestamp'] >= today_start_ms and s['seasonEligibility'] != "IN_SEASON")
+    for p in SALES_AVG_PERIODS:
         is_prices, cl_prices = [], []
         for s in all_sales:
             if s['timestamp'] >= now_ms - (p * 86400000):
@@ -411,19 +1273,41 @@ def build_sales_history_row(name, slug, rarity, all_sales, headers):
                     is_prices.append(s['price'])
                 else: 
                     cl_prices.append(s['price'])
-        out_row_map[f"Avg Price {p}d (In-Season)"] = format_price_as_string(round(sum(is_prices)/len(is_prices), 2)) if is_prices else ""
-        out_row_map[f"Avg Price {p}d (Classic)"] = format_price_as_string(round(sum(cl_prices)/len(cl_prices), 2)) if cl_prices else ""
-    for j in range(MAX_SALES_TO_DISPLAY):
-        if j < len(all_sales):
-            sale = all_sales[j]
-            out_row_map[f"Sale {j+1} Date"] = datetime.fromtimestamp(sale['timestamp']/1000).strftime('%Y-%m-%d %H:%M:%S')
-            # 🚀 CORREZIONE CRITICA: Formatta il prezzo come stringa
-            out_row_map[f"Sale {j+1} Price (EUR)"] = format_price_as_string(sale['price'])
-            out_row_map[f"Sale {j+1} Eligibility"] = sale['seasonEligibility']
-        else:
-            out_row_map[f"Sale {j+1} Date"], out_row_map[f"Sale {j+1} Price (EUR)"], out_row_map[f"Sale {j+1} Eligibility"] = "", "", ""
-    out_row_map["Last Updated"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    return [out_row_map.get(h, '') for h in headers]
+        row[f"Avg Price {p}d (In-Season)"] = format_price_as_string(round(sum(is_prices)/len(is_prices), 2)) if is_prices else ""
+        row[f"Avg Price {p}d (Classic)"] = format_price_as_string(round(sum(cl_prices)/len(cl_prices), 2)) if cl_prices else ""
+    values = row.values
+    for sale, (date_idx, price_idx, elig_idx) in zip(all_sales, SALE_COLUMN_INDEXES):
+        values[date_idx] = datetime.fromtimestamp(sale['timestamp']/1000).strftime('%Y-%m-%d %H:%M:%S')
+        # 🚀 CORREZIONE CRITICA: Formatta il prezzo come stringa
+        values[price_idx] = format_price_as_string(sale['price'])
+        values[elig_idx] = sale['seasonEligibility']
+    row["Last Updated"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return values
+
+def parse_sheet_sales(values, api_prices_for_comparison):
+    """Estrae le vendite già presenti in una riga vendite (lista di valori), con correzione automatica dei prezzi."""
+    old_sales = []
+    for j, (date_idx, price_idx, elig_idx) in enumerate(SALE_COLUMN_INDEXES, start=1):
+        date_str, price_val = values[date_idx], values[price_idx]
+        if date_str and price_val:
+            raw_price = parse_price(price_val)  # parse_price restituisce il valore raw dal foglio
+            if raw_price is not None:
+                # CORREZIONE AUTOMATICA: Confronta con i prezzi API
+                corrected_price = smart_price_correction(raw_price, api_prices_for_comparison)
+                
+                try:
+                    timestamp = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S').timestamp() * 1000
+                    old_sales.append({
+                        "timestamp": timestamp, 
+                        "price": corrected_price,  # USA IL PREZZO CORRETTO
+                        "seasonEligibility": values[elig_idx]
+                    })
+                    if j <= 3:  # Debug log
+                        correction_note = " (corretto)" if corrected_price != raw_price else ""
+                        print(f"  📄 Foglio Sale {j}: {corrected_price} EUR{correction_note}")
+                except (ValueError, TypeError):
+                    continue
+    return old_sales
 
 def check_sheet_health(sales_sheet, expected_headers):
     """
@@ -434,15 +1318,10 @@ def check_sheet_health(sales_sheet, expected_headers):
         # Prova a leggere gli header esistenti
         existing_headers = sales_sheet.row_values(1) if sales_sheet.row_count > 0 else []
         
-        # Controlla se possiamo leggere i record (test per header duplicati)
-        try:
-            test_records = sales_sheet.get_all_records()
-            print(f"Test lettura records: OK ({len(test_records)} righe)")
-        except Exception as e:
-            if "duplicates" in str(e).lower() or "header" in str(e).lower():
-                return False, True, f"Header duplicati/vuoti: {e}"
-            else:
-                return False, False, f"Errore generico lettura: {e}"
+        # Header duplicati/vuoti: controllati direttamente sulla riga 1, senza scaricare tutto il foglio
+        if len(set(existing_headers)) != len(existing_headers):
+            duplicates = sorted({h for h in existing_headers if existing_headers.count(h) > 1})
+            return False, True, f"Header duplicati/vuoti: {duplicates}"
         
         # Controlla dimensioni
         num_expected_cols = len(expected_headers)
@@ -467,13 +1346,325 @@ def check_sheet_health(sales_sheet, expected_headers):
     except Exception as e:
         return False, True, f"Errore grave nel controllo: {e}"
 
+def column_letter(col_index):
+    """Lettera di colonna A1 per un indice 1-based (1 -> A, 27 -> AA)."""
+    return gspread.utils.rowcol_to_a1(1, col_index)[:-1]
+
+def read_sheet_columns(sheet, column_names, headers=None):
+    """
+    Legge solo le colonne indicate (per nome di header) con un'unica batch_get invece di
+    get_all_records. Ritorna una lista di tuple (row_index, valore1, valore2, ...) per
+    ogni riga dati; le colonne non presenti nel foglio risultano vuote.
+    """
+    headers = headers if headers is not None else sheet.row_values(1)
+    ranges, positions = [], []
+    for name in column_names:
+        if name in headers:
+            letter = column_letter(headers.index(name) + 1)
+            positions.append(len(ranges))
+            ranges.append(f"{letter}2:{letter}")
+        else:
+            positions.append(None)
+    value_ranges = sheet.batch_get(ranges) if ranges else []
+    columns = [[row[0] if row else '' for row in value_range] for value_range in value_ranges]
+    num_rows = max((len(column) for column in columns), default=0)
+    rows = []
+    for i in range(num_rows):
+        values = tuple(
+            columns[pos][i] if pos is not None and i < len(columns[pos]) else ''
+            for pos in positions
+        )
+        rows.append((i + 2,) + values)
+    return rows
+
+def read_sheet_rows(sheet, row_indexes, headers, row_class=None):
+    """Legge righe intere (solo quelle indicate) con un'unica batch_get. Ritorna {row_index: riga di tipo row_class}."""
+    if not row_indexes:
+        return {}
+    row_class = row_class or MainRow
+    last_letter = column_letter(len(headers))
+    value_ranges = sheet.batch_get([f"A{r}:{last_letter}{r}" for r in row_indexes])
+    records = {}
+    for row_index, value_range in zip(row_indexes, value_ranges):
+        records[row_index] = row_class.from_sheet_values(value_range[0] if value_range else [], headers)
+    return records
+
+def resolve_slug_rows(sheet, headers):
+    """
+    Indice {slug: riga} letto al momento dalla sola colonna Slug. Le righe vanno indirizzate per
+    slug e risolte subito prima di leggere o scrivere: inserimenti ed eliminazioni concorrenti
+    (sync_galleria, modifiche a mano) spostano gli indici salvati in precedenza.
+    """
+    return {slug: row_index for row_index, slug in read_sheet_columns(sheet, ["Slug"], headers) if slug}
+
+def flush_card_updates(sheet, headers, pending_updates):
+    """
+    Scrive le righe aggiornate ([slug, valori]) nelle righe dove si trovano ORA i rispettivi slug,
+    con un'unica batch_update, e svuota il buffer. Le carte rimosse nel frattempo vengono saltate.
+    Ritorna le coppie (riga, valori) effettivamente scritte. Il marcatore dei punteggi di una
+    carta ([slug, valori, caricamento punteggi]) si registra solo dopo la scrittura della riga.
+    """
+    if not pending_updates:
+        return []
+    fence("main_sheet")
+    slug_rows = resolve_slug_rows(sheet, headers)
+    data, written, scores_loaded = [], [], {}
+    # Checkpoint del formato precedente: [slug, valori] senza marcatore dei punteggi
+    for slug, values, *scores_at in pending_updates:
+        row_index = slug_rows.get(slug)
+        if row_index is None:
+            print(f"AVVISO: {slug} non è più nel foglio. Aggiornamento saltato.")
+            continue
+        data.append({'range': f'A{row_index}', 'values': [values]})
+        written.append((row_index, values))
+        if scores_at and scores_at[0]:
+            scores_loaded[slug] = scores_at[0]
+    if data:
+        print(f"📝 Scrittura di {len(data)} righe aggiornate...")
+        sheet.batch_update(data, value_input_option='USER_ENTERED')
+    SCORES_REFRESHED_AT.update(scores_loaded)
+    pending_updates.clear()
+    return written
+
+_pyarrow_warned = False
+
+def import_pyarrow():
+    """pyarrow è opzionale: senza, gli snapshot colonnari vengono saltati (con un solo avviso)."""
+    global _pyarrow_warned
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        return pyarrow
+    except ImportError:
+        if not _pyarrow_warned:
+            print("AVVISO: pyarrow non installato, snapshot colonnari disattivati (pip install pyarrow).")
+            _pyarrow_warned = True
+        return None
+
+def write_snapshot_partition(table_name, user_slug, fields, rows):
+    """
+    Aggiunge una partizione a SNAPSHOT_DIR/<tabella>/: un file Arrow IPC non compresso (quindi
+    mappabile in memoria con pyarrow.memory_map) con le righe di questa esecuzione. Le
+    partizioni precedenti non vengono toccate. Ritorna True se non c'era nulla da scrivere
+    o se la partizione è stata scritta.
+    """
+    if not rows:
+        return True
+    pa = import_pyarrow()
+    if pa is None:
+        return False
+    types = {"string": pa.string(), "int64": pa.int64(), "float64": pa.float64(), "timestamp_ms": pa.timestamp("ms", tz="UTC")}
+    schema = pa.schema([(name, types[type_name]) for name, type_name in fields])
+    columns = [pa.array([row[j] for row in rows], type=field.type) for j, field in enumerate(schema)]
+    table = pa.Table.from_arrays(columns, schema=schema)
+    directory = os.path.join(SNAPSHOT_DIR, table_name)
+    os.makedirs(directory, exist_ok=True)
+    shard_suffix = f"-shard{SHARD_INDEX}of{SHARD_COUNT}" if SHARD_COUNT > 1 else ""
+    path = os.path.join(directory, f"run={datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{user_slug}{shard_suffix}.arrow")
+    tmp_path = f"{path}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    print(f"Snapshot {table_name}: {len(rows)} righe in {path}")
+    return True
+
+def parse_snapshot_time(value):
+    """Istante in ms di una data del foglio carte (quella delle partite, 'YYYY-MM-DD HH:MM:SS' o ISO 8601) o None."""
+    text = "" if value is None else str(value).strip()
+    if not text:
+        return None
+    fixture_time = parse_fixture_time(text)
+    if fixture_time is not None:
+        return int(fixture_time * 1000)
+    try:
+        return int(datetime.fromisoformat(text.replace("Z", "+00:00")).timestamp() * 1000)
+    except ValueError:
+        return None
+
+def snapshot_value(type_name, value):
+    """Valore del foglio convertito nel tipo della colonna dello snapshot (None se vuoto o non leggibile)."""
+    if type_name == "string":
+        return "" if value is None else str(value)
+    if type_name == "timestamp_ms":
+        return parse_snapshot_time(value)
+    number = parse_price(value)
+    if number is None or type_name == "float64":
+        return number
+    return int(number)
+
+def write_cards_snapshot(user_slug, updated_rows):
+    """updated_rows: lista di (row_index, valori MAIN_SHEET_HEADERS) scritti in questa esecuzione."""
+    value_types = [type_name for _, type_name in CARDS_SNAPSHOT_FIELDS[2:]]
+    rows = [[user_slug, row_index] + [snapshot_value(type_name, v) for type_name, v in zip(value_types, values)] for row_index, values in updated_rows]
+    try:
+        write_snapshot_partition("cards", user_slug, CARDS_SNAPSHOT_FIELDS, rows)
+    except Exception as e:
+        print(f"Errore scrittura snapshot carte: {e}")
+
+# --- 3b. MOTORE DI ALERT ---
+ALERT_COMPARISON_OPS = ("<", "<=", ">", ">=")
+ALERT_TRANSITION_OPS = ("cleared", "set")  # colonna svuotata (es. infortunio rientrato) / valorizzata
+
+def load_alert_rules():
+    """
+    Regole da ALERT_RULES_FILE: lista JSON di oggetti
+    {"id", "column", "op", "value", "player"?, "rarity"?, "label"?}, con op tra
+    ALERT_COMPARISON_OPS (value numerico) o ALERT_TRANSITION_OPS. "player" (Player API Slug)
+    e "rarity" restringono la regola. Le regole non valide vengono segnalate e ignorate.
+    """
+    try:
+        with open(ALERT_RULES_FILE, "r") as f:
+            raw_rules = json.load(f)
+    except FileNotFoundError:
+        return []
+    except json.JSONDecodeError as e:
+        print(f"AVVISO: {ALERT_RULES_FILE} non valido ({e}). Alert disattivati.")
+        return []
+    rules, seen_ids = [], set()
+    for n, rule in enumerate(raw_rules if isinstance(raw_rules, list) else []):
+        rule_id, op = str(rule.get("id") or f"regola-{n + 1}"), rule.get("op")
+        if rule_id in seen_ids or rule.get("column") not in MAIN_SHEET_HEADERS + SALES_HISTORY_HEADERS:
+            print(f"AVVISO: regola alert '{rule_id}' ignorata (id duplicato o colonna sconosciuta).")
+            continue
+        if op in ALERT_COMPARISON_OPS:
+            try:
+                threshold = float(rule.get("value"))
+            except (TypeError, ValueError):
+                print(f"AVVISO: regola alert '{rule_id}' ignorata (soglia non numerica).")
+                continue
+        elif op in ALERT_TRANSITION_OPS:
+            threshold = None
+        else:
+            print(f"AVVISO: regola alert '{rule_id}' ignorata (operatore '{op}' sconosciuto).")
+            continue
+        seen_ids.add(rule_id)
+        rules.append({
+            "id": rule_id, "column": rule["column"], "op": op, "value": threshold,
+            "player": rule.get("player") or "*", "rarity": str(rule.get("rarity") or "").lower(),
+            "label": rule.get("label") or f"{rule['column']} {op}{'' if threshold is None else f' {threshold:g}'}",
+        })
+    return rules
+
+def rules_fingerprint(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode()).hexdigest()[:12]
+
+class AlertEngine:
+    """
+    Regole di alert di una sorgente ("cards" = foglio principale, "sales" = cronologia vendite)
+    valutate sulle righe man mano che gli stage le producono. Per ogni colonna e giocatore
+    (o "*") le soglie di ogni operatore sono tenute ordinate: un valore cambiato trova con
+    bisect le sole regole scattate, senza scorrere le altre. Gli alert già inviati stanno
+    nello stato ({entità: {regola: timestamp}}) e si riarmano quando la condizione smette di
+    valere; quelli nuovi finiscono in un unico riepilogo Telegram a fine stage.
+    """
+    def __init__(self, source, rules, headers, rarity_column, saved):
+        self.source, self.headers, self.rarity_column = source, headers, rarity_column
+        self.rules = {rule["id"]: rule for rule in rules}
+        self.positions = {header: i for i, header in enumerate(headers)}
+        self.fingerprint = rules_fingerprint(rules)
+        # Regole tolte dal file: i loro alert inviati non servono più
+        self.sent = {entity: {r: ts for r, ts in fired.items() if r in self.rules} for entity, fired in saved.get("sent", {}).items()}
+        self.sent = {entity: fired for entity, fired in self.sent.items() if fired}
+        # Regole nuove o modificate: alla prima esecuzione si valutano anche i valori invariati
+        self.full = saved.get("rules") != self.fingerprint
+        self.fired = []
+        self.index = {}  # colonna -> giocatore|"*" -> op -> (soglie ordinate, regole nello stesso ordine)
+        for rule in sorted(rules, key=lambda r: (r["value"] is None, r["value"] or 0)):
+            thresholds, bucket = self.index.setdefault(rule["column"], {}).setdefault(rule["player"], {}).setdefault(rule["op"], ([], []))
+            thresholds.append(rule["value"])
+            bucket.append(rule)
+
+    def _triggered(self, by_player, number, old_value, new_value):
+        for op, (thresholds, bucket) in by_player.items():
+            if op in ALERT_TRANSITION_OPS:
+                if (op == "cleared" and old_value and not new_value) or (op == "set" and new_value and not old_value):
+                    yield from bucket
+            elif number is not None:
+                if op == "<":
+                    yield from bucket[bisect.bisect_right(thresholds, number):]
+                elif op == "<=":
+                    yield from bucket[bisect.bisect_left(thresholds, number):]
+                elif op == ">":
+                    yield from bucket[:bisect.bisect_left(thresholds, number)]
+                else:
+                    yield from bucket[:bisect.bisect_right(thresholds, number)]
+
+    def observe(self, entity, old_values, new_values):
+        """Valuta una riga appena prodotta (old_values None se la riga è nuova)."""
+        def cell(values, column):
+            position = self.positions[column]
+            return str(values[position]).strip() if values and position < len(values) else ""
+        player, rarity = cell(new_values, "Player API Slug"), cell(new_values, self.rarity_column).lower()
+        active = self.sent.get(entity, {})
+        for column, by_scope in self.index.items():
+            old_value, new_value = cell(old_values, column), cell(new_values, column)
+            if old_value == new_value and not self.full:
+                continue
+            number = parse_price(new_value)
+            triggered = {}
+            for scope in (player, "*"):
+                for rule in self._triggered(by_scope.get(scope, {}), number, old_value, new_value):
+                    if not rule["rarity"] or rule["rarity"] == rarity:
+                        triggered[rule["id"]] = rule
+            # Riarmo: regole della colonna inviate in passato la cui condizione non vale più
+            for rule_id in [r for r in active if r not in triggered and self.rules.get(r, {}).get("column") == column]:
+                del active[rule_id]
+            for rule_id, rule in triggered.items():
+                if rule_id not in active:
+                    active[rule_id] = int(time.time())
+                    self.fired.append((rule, cell(new_values, "Player Name"), rarity, new_value))
+        if active:
+            self.sent[entity] = active
+        else:
+            self.sent.pop(entity, None)
+
+ACTIVE_ALERTS = {}
+
+def start_alerts(source, headers, rarity_column):
+    """Prepara il motore di alert di uno stage; nessun motore se non ci sono regole per la sorgente."""
+    rules = [rule for rule in load_alert_rules() if rule["column"] in headers]
+    ACTIVE_ALERTS.pop(source, None)
+    if rules:
+        saved = load_state().get(f"{ALERTS_STATE_KEY_PREFIX}{source}", {})
+        ACTIVE_ALERTS[source] = AlertEngine(source, rules, headers, rarity_column, saved)
+        print(f"Alert attivi ({source}): {len(rules)} regole.")
+
+def observe_alerts(source, entity, old_values, new_values):
+    engine = ACTIVE_ALERTS.get(source)
+    if engine is not None:
+        engine.observe(entity, old_values, new_values)
+
+def finish_alerts(source, title):
+    """Salva gli alert inviati nello stato e manda un solo riepilogo Telegram con quelli nuovi."""
+    engine = ACTIVE_ALERTS.pop(source, None)
+    if engine is None:
+        return
+    state = load_state()
+    # Si salva anche senza alert nuovi: l'impronta delle regole e i riarmi vanno ricordati
+    state[f"{ALERTS_STATE_KEY_PREFIX}{source}"] = {"rules": engine.fingerprint, "sent": engine.sent}
+    save_state(state)
+    if not engine.fired:
+        return
+    lines = [
+        f"• <b>{html.escape(rule['label'])}</b>: {html.escape(name)} ({rarity}) → {html.escape(value) or 'vuoto'}"
+        for rule, name, rarity, value in engine.fired[:ALERT_DIGEST_MAX_ITEMS]
+    ]
+    if len(engine.fired) > ALERT_DIGEST_MAX_ITEMS:
+        lines.append(f"… e altri {len(engine.fired) - ALERT_DIGEST_MAX_ITEMS}")
+    print(f"🔔 {len(engine.fired)} alert nuovi ({source}).")
+    send_telegram_notification(f"🔔 <b>{title}</b> ({len(engine.fired)})\\n\\n" + "\\n".join(lines))
+
 # --- 4. FUNZIONI PRINCIPALI ---
 def sync_galleria():
-    print("--- INIZIO SINCRONIZZAZIONE GALLERIA ---")
+    for user_slug, spreadsheet_id in get_galleries():
+        # Eliminazioni e aggiunte spostano le righe: il foglio principale resta bloccato per tutta la sincronizzazione
+        with_leases(spreadsheet_id, ["main_sheet"], sync_galleria_for, user_slug, spreadsheet_id)
+
+def sync_galleria_for(user_slug, spreadsheet_id):
+    print(f"--- INIZIO SINCRONIZZAZIONE GALLERIA{gallery_label(user_slug)} ---")
     try:
-        credentials = json.loads(GSPREAD_CREDENTIALS_JSON)
-        gc = gspread.service_account_from_dict(credentials)
-        spreadsheet = gc.open_by_key(SPREADSHEET_ID)
+        spreadsheet = get_gspread_client().open_by_key(spreadsheet_id)
         try:
             sheet = spreadsheet.worksheet(MAIN_SHEET_NAME)
             if not sheet.row_values(1):
@@ -488,25 +1679,16 @@ def sync_galleria():
         print(f"ERRORE CRITICO GSheets in sync_galleria: {e}")
         return
     print("Recupero di tutte le carte dall'API di Sorare...")
-    api_cards = []
-    cursor, has_next_page = None, True
-    while has_next_page:
-        variables = {"userSlug": USER_SLUG, "rarities": ["limited", "rare", "super_rare", "unique"], "cursor": cursor}
-        data = sorare_graphql_fetch(ALL_CARDS_QUERY, variables)
-        if not data or "errors" in data or not data.get("data", {}).get("user", {}).get("cards"):
-            break
-        cards_data = data["data"]["user"]["cards"]
-        api_cards.extend(cards_data.get("nodes", []))
-        page_info = cards_data.get("pageInfo", {})
-        has_next_page, cursor = page_info.get("hasNextPage", False), page_info.get("endCursor")
-        if has_next_page: 
-            time.sleep(1)
+    api_cards = fetch_all_user_cards(user_slug)
+    if api_cards is None:
+        # Una galleria incompleta farebbe rimuovere dal foglio carte ancora possedute
+        print("ERRORE: recupero galleria incompleto. Sincronizzazione annullata.")
+        return
     api_card_slugs = {card['slug'] for card in api_cards}
     print(f"Recupero completato. Trovate {len(api_card_slugs)} carte uniche in totale.")
     print("Leggo le carte presenti nel foglio Google...")
     try:
-        sheet_records = sheet.get_all_records()
-        sheet_card_slugs = {record['Slug']: {'row_index': i + 2} for i, record in enumerate(sheet_records) if record.get('Slug')}
+        sheet_card_slugs = {slug: {'row_index': row_index} for row_index, slug in read_sheet_columns(sheet, ["Slug"]) if slug}
     except gspread.exceptions.GSpreadException as e:
         print(f"Attenzione: il foglio '{MAIN_SHEET_NAME}' sembra vuoto o malformato. Verrà trattato come vuoto. Dettagli: {e}")
         sheet_card_slugs = {}
@@ -517,6 +1699,7 @@ def sync_galleria():
         rows_to_delete = sorted([sheet_card_slugs[slug]['row_index'] for slug in slugs_to_delete], reverse=True)
         print(f"Rimozione di {len(rows_to_delete)} righe...")
         for row_index in rows_to_delete:
+            fence("main_sheet")
             try:
                 sheet.delete_rows(row_index)
                 time.sleep(1.5)
@@ -525,52 +1708,208 @@ def sync_galleria():
     if slugs_to_add:
         new_cards_data = [card for card in api_cards if card['slug'] in slugs_to_add]
         data_to_write = []
-        empty_record = {header: "" for header in MAIN_SHEET_HEADERS}
         for card in new_cards_data:
             player = card.get("player") or {}
-            record = empty_record.copy()
+            record = MainRow()
             record["Slug"], record["Rarity"], record["Owner Since"] = card.get("slug", ""), card.get("rarity", ""), card.get("ownerSince", "")
             record["Player Name"], record["Player API Slug"] = player.get("displayName", ""), player.get("slug", "")
             record["Position"], record["U23 Eligible?"] = player.get("position", ""), "Sì" if player.get("u23Eligible") else "No"
-            data_to_write.append([record.get(header, '') for header in MAIN_SHEET_HEADERS])
+            data_to_write.append(record.values)
         if data_to_write:
             print(f"Aggiunta di {len(data_to_write)} nuove carte al foglio...")
+            fence("main_sheet")
             sheet.append_rows(data_to_write, value_input_option='USER_ENTERED')
-    message = f"✅ <b>Sincronizzazione Galleria Completata</b>\\n\\nGalleria: {len(api_card_slugs)} carte\\n➕ Aggiunte: {len(slugs_to_add)}\\n➖ Rimosse: {len(slugs_to_delete)}"
+    message = f"✅ <b>Sincronizzazione Galleria Completata</b>{gallery_label(user_slug)}\\n\\nGalleria: {len(api_card_slugs)} carte\\n➕ Aggiunte: {len(slugs_to_add)}\\n➖ Rimosse: {len(slugs_to_delete)}"
     print(message)
     send_telegram_notification(message)
 
+def fetch_card_update(card_slug, record):
+    """
+    Fase di fetch di una carta: dettagli, prossima partita, proiezione e l'istante del caricamento
+    dei punteggi (None se non ricaricati). Ritorna None se l'API non risponde.
+    """
+    stored_player_slug, now = record['Player API Slug'], time.time()
+    # Il marcatore è per carta: ogni riga porta i propri punteggi, anche se il giocatore è condiviso
+    include_scores = scores_need_refresh(record, SCORES_REFRESHED_AT.get(card_slug), now)
+    card_details, player_info = fetch_card_details(card_slug, stored_player_slug, include_scores)
+    if not card_details:
+        return None
+    player_slug = player_info.get("slug") if player_info else None
+
+    kickoff = parse_fixture_time(record["Data Prossima Partita"])
+    if not include_scores and kickoff is not None and kickoff <= now:
+        # Partita in corso e punteggi non ancora ricaricati: la riga resta sulla partita in corso
+        fixture, game_id = None, record["Next Game API ID"] or None
+    else:
+        # Prossima partita dalla cache per club (una query per club, non per giocatore)
+        fixture = fetch_club_fixture((player_info or card_details.get("player") or {}).get("activeClub"))
+        game_id = fixture.get("Next Game API ID") if fixture else None
+
+    projection_data = fetch_projection(player_slug, game_id)
+    # Il marcatore lo registra chi scrive, a riga scritta: una riga scartata va ricaricata
+    return card_details, player_info, projection_data, fixture, now if include_scores else None
+
+def card_update_pipeline(spreadsheet_id, headers, cards_to_process, start_index, rates, deadline):
+    """
+    Pipeline a stadi di update_cards: un lettore (righe del foglio a blocchi, per slug) alimenta
+    CARDS_FETCH_WORKERS fetcher (API Sorare, sotto SORARE_RATE_LIMITER), che alimentano la
+    trasformazione (build_updated_card_row). Genera (indice, slug, riga aggiornata o None,
+    riga letta dal foglio, caricamento dei punteggi o None) in ordine di indice, così chi scrive può salvare il checkpoint sul primo indice non scritto.
+    Al massimo CARDS_PIPELINE_DEPTH carte sono in volo tra lettore e scrittore: uno scrittore
+    lento ferma il lettore. Dopo `deadline` non si avviano altre carte: la pipeline si svuota
+    delle sole carte già in lavorazione e quelle scartate restano per la prossima esecuzione.
+    Il lettore apre il foglio con un proprio client gspread: la sessione HTTP del client
+    condiviso resta al thread principale, che scrive.
+    """
+    stop = threading.Event()
+    window = threading.BoundedSemaphore(CARDS_PIPELINE_DEPTH)
+    fetch_queue, transform_queue, output_queue = queue.Queue(), queue.Queue(), queue.Queue()
+    done = object()
+
+    def run_stage_thread(body):
+        try:
+            body()
+        except BaseException as e:
+            stop.set()
+            output_queue.put(e)
+
+    def reader():
+        loaded_records = {}
+        try:
+            sheet = new_gspread_client().open_by_key(spreadsheet_id).worksheet(MAIN_SHEET_NAME)
+            for i in range(start_index, len(cards_to_process)):
+                while not window.acquire(timeout=0.5):
+                    if stop.is_set():
+                        return
+                if stop.is_set() or time.time() > deadline:
+                    return
+                card_slug = cards_to_process[i].get('Slug')
+                if card_slug and card_slug not in loaded_records:
+                    # Le righe del blocco si cercano per slug: la row_index del piano può essere cambiata
+                    chunk_slugs = [c['Slug'] for c in cards_to_process[i:i + BATCH_SIZE] if c.get('Slug')]
+                    slug_rows = resolve_slug_rows(sheet, headers)
+                    rows = read_sheet_rows(sheet, [slug_rows[slug] for slug in chunk_slugs if slug in slug_rows], headers)
+                    loaded_records.update({record['Slug']: record for record in rows.values() if record['Slug'] in chunk_slugs})
+                fetch_queue.put((i, card_slug, loaded_records.pop(card_slug, None) if card_slug else None))
+        finally:
+            for _ in range(CARDS_FETCH_WORKERS):
+                fetch_queue.put(done)
+
+    def fetcher():
+        try:
+            while True:
+                item = fetch_queue.get()
+                if item is done:
+                    return
+                if time.time() > deadline:
+                    stop.set()  # Budget esaurito: si finiscono solo le carte già avviate
+                if stop.is_set():
+                    continue  # Arresto: la carta non viene scritta e resta per la prossima esecuzione
+                i, card_slug, record = item
+                if record is None:
+                    if card_slug:
+                        print(f"AVVISO: {card_slug} non è più nel foglio. Salto.")
+                    transform_queue.put((i, card_slug, None, None))
+                    continue
+                print(f"Aggiorno carta ({i+1}/{len(cards_to_process)}): {card_slug}")
+                transform_queue.put((i, card_slug, record, fetch_card_update(card_slug, record)))
+        finally:
+            transform_queue.put(done)
+
+    def transformer():
+        finished_fetchers = 0
+        while finished_fetchers < CARDS_FETCH_WORKERS:
+            item = transform_queue.get()
+            if item is done:
+                finished_fetchers += 1
+                continue
+            i, card_slug, record, fetched = item
+            updated_row, scores_at = None, None
+            if fetched:
+                card_details, player_info, projection_data, fixture, scores_at = fetched
+                updated_row = build_updated_card_row(record, card_details, player_info, projection_data, rates, fixture)
+            output_queue.put((i, card_slug, updated_row, record, scores_at))
+        output_queue.put(done)
+
+    threads = [threading.Thread(target=run_stage_thread, args=(reader,), daemon=True)]
+    threads += [threading.Thread(target=run_stage_thread, args=(fetcher,), daemon=True) for _ in range(CARDS_FETCH_WORKERS)]
+    threads.append(threading.Thread(target=run_stage_thread, args=(transformer,), daemon=True))
+    for thread in threads:
+        thread.start()
+    ready, next_index = {}, start_index
+    try:
+        while True:
+            while next_index in ready:
+                yield (next_index,) + ready.pop(next_index)
+                next_index += 1
+                window.release()
+            try:
+                # Attesa a intervalli: SIGTERM nel thread principale deve poter interrompere
+                item = output_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is done:
+                return  # Eventuali risultati oltre un buco (carte scartate all'arresto) si perdono
+            if isinstance(item, BaseException):
+                raise item
+            ready[item[0]] = item[1:]
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=5)
+
 def update_cards():
-    print("--- INIZIO AGGIORNAMENTO DATI CARTE (OTTIMIZZATO) ---")
-    start_time, state = time.time(), load_state()
-    continuation_data = state.get('update_cards_continuation', {})
+    start_time = time.time()
+    rates = {"eth_to_eur": get_eth_rate()}
+    rates.update(get_currency_rates())
+    state = load_state()
+    CLUB_FIXTURE_CACHE.update(state.get(CLUB_FIXTURES_STATE_KEY, {}))
+    SCORES_REFRESHED_AT.update(state.get(SCORE_REFRESH_STATE_KEY, {}))
+    start_alerts("cards", MAIN_SHEET_HEADERS, "Rarity")
+    try:
+        for user_slug, spreadsheet_id in get_galleries():
+            # Le gallerie condividono il budget di tempo: se una va in timeout le successive aspettano il prossimo giro
+            if not with_leases(spreadsheet_id, ["main_sheet"], update_cards_for, user_slug, spreadsheet_id, rates, start_time):
+                break
+    finally:
+        state, now = load_state(), time.time()
+        state[CLUB_FIXTURES_STATE_KEY] = {slug: entry for slug, entry in CLUB_FIXTURE_CACHE.items() if entry["expires"] > now}
+        state[SCORE_REFRESH_STATE_KEY] = {slug: ts for slug, ts in SCORES_REFRESHED_AT.items() if now - ts <= SCORE_MAX_AGE_HOURS * 3600}
+        save_state(state)
+        finish_alerts("cards", "Alert Carte")
+
+def update_cards_for(user_slug, spreadsheet_id, rates, start_time):
+    """Aggiorna le carte di una galleria. Ritorna False se il budget di tempo è esaurito."""
+    print(f"--- INIZIO AGGIORNAMENTO DATI CARTE (OTTIMIZZATO){gallery_label(user_slug)} ---")
+    gallery_start, state = time.time(), load_state()
+    state_key = gallery_state_key('update_cards_continuation', user_slug)
+    continuation_data = state.get(state_key, {})
     start_index = continuation_data.get('last_index', 0)
     try:
-        credentials = json.loads(GSPREAD_CREDENTIALS_JSON)
-        gc = gspread.service_account_from_dict(credentials)
-        sheet = gc.open_by_key(SPREADSHEET_ID).worksheet(MAIN_SHEET_NAME)
+        sheet = get_gspread_client().open_by_key(spreadsheet_id).worksheet(MAIN_SHEET_NAME)
         print("Connessione a Google Sheets riuscita.")
     except Exception as e:
         print(f"ERRORE CRITICO GSheets: {e}")
-        return
-    rates = {"eth_to_eur": get_eth_rate()}
-    rates.update(get_currency_rates())
-    if start_index == 0:
+        return True
+    headers = sheet.row_values(1)
+    if 'cards_to_process' not in continuation_data:
         print("Avvio nuova sessione...")
-        all_sheet_records = sheet.get_all_records()
+        # Per pianificare bastano Slug e Ultimo Aggiornamento: le righe intere si leggono dopo, a blocchi
         cutoff_time = datetime.now() - timedelta(hours=CARD_DATA_UPDATE_INTERVAL_HOURS)
         cards_to_process = []
-        for i, record in enumerate(all_sheet_records):
-            record['row_index'] = i + 2
-            last_update_str = record.get('Ultimo Aggiornamento', '').strip()
+        for _, slug, last_update in read_sheet_columns(sheet, ["Slug", "Ultimo Aggiornamento"], headers):
+            if not slug or not in_current_shard(slug):
+                continue
+            card_ref = {'Slug': slug}  # Niente indice di riga: viene risolto per slug al momento
+            last_update_str = str(last_update).strip()
             if not last_update_str:
-                cards_to_process.append(record)
+                cards_to_process.append(card_ref)
                 continue
             try:
                 if datetime.strptime(last_update_str, '%Y-%m-%d %H:%M:%S') < cutoff_time:
-                    cards_to_process.append(record)
+                    cards_to_process.append(card_ref)
             except ValueError:
-                cards_to_process.append(record)
+                cards_to_process.append(card_ref)
         print(f"Identificate {len(cards_to_process)} carte da aggiornare.")
         continuation_data['cards_to_process'] = cards_to_process
     else:
@@ -578,88 +1917,102 @@ def update_cards():
         cards_to_process = continuation_data.get('cards_to_process', [])
     if not cards_to_process:
         print("Nessuna carta da aggiornare.")
-        if 'update_cards_continuation' in state: 
-            del state['update_cards_continuation']
+        if state_key in state: 
+            del state[state_key]
         save_state(state)
-        return
-    for i in range(start_index, len(cards_to_process)):
-        if time.time() - start_time > 300:
-            print(f"Timeout imminente. Salvo stato all'indice {i}.")
-            continuation_data['last_index'] = i
-            state['update_cards_continuation'] = continuation_data
-            save_state(state)
-            return
-        card_to_update = cards_to_process[i]
-        card_slug = card_to_update.get('Slug')
-        if not card_slug: 
-            continue
-        print(f"Aggiorno carta ({i+1}/{len(cards_to_process)}): {card_slug}")
-        details_data = sorare_graphql_fetch(OPTIMIZED_CARD_DETAILS_QUERY, {"cardSlug": card_slug})
-        if not details_data or not details_data.get("data", {}).get("anyCard"):
-            time.sleep(1)
-            continue
-        card_details = details_data["data"]["anyCard"]
-        player_info = card_details.get("player")
-        player_slug = player_info.get("slug") if player_info else None
-
-        # Get game_id from the club's upcoming games
-        upcoming_games = []
-        if player_info and player_info.get("activeClub"):
-            upcoming_games = player_info.get("activeClub", {}).get("upcomingGames", [])
-        game_id = upcoming_games[0].get("id") if upcoming_games else None
-
-        projection_data = fetch_projection(player_slug, game_id)
-        updated_row = build_updated_card_row(card_to_update, card_details, player_info, projection_data, rates)
-        try:
-            sheet.update(range_name=f'A{card_to_update["row_index"]}', values=[updated_row], value_input_option='USER_ENTERED')
-        except Exception as e:
-            print(f"Errore aggiornamento riga per {card_slug}: {e}")
-        time.sleep(1)
+        return True
+    # Righe aggiornate non ancora scritte ([slug, valori, caricamento punteggi]): fanno parte della continuazione
+    pending_updates = continuation_data.setdefault('pending_updates', [])
+    checkpoint = Checkpointer(state, state_key, continuation_data)
+    snapshot_rows = []
+    if pending_updates:
+        print(f"Ripresa: scrivo {len(pending_updates)} righe in sospeso dal checkpoint...")
+        snapshot_rows.extend(flush_card_updates(sheet, headers, pending_updates))
+    checkpoint.save(start_index)  # Il piano è subito persistito: un crash non lo fa ricalcolare
+    # Lo scrittore è il thread principale: riceve le carte in ordine, le accumula e scrive a blocchi
+    pipeline = card_update_pipeline(spreadsheet_id, headers, cards_to_process, start_index, rates, start_time + CARDS_TIME_BUDGET_SECONDS)
+    next_index = start_index
+    try:
+        for index, card_slug, updated_row, record, scores_at in pipeline:
+            next_index = index + 1
+            if updated_row is not None:
+                pending_updates.append([card_slug, updated_row, scores_at])
+                observe_alerts("cards", card_slug, record.values, updated_row)
+            if len(pending_updates) >= BATCH_SIZE:
+                snapshot_rows.extend(flush_card_updates(sheet, headers, pending_updates))
+                checkpoint.save(next_index)
+            else:
+                checkpoint.tick(next_index)
+        checkpoint.save(next_index)
+        snapshot_rows.extend(flush_card_updates(sheet, headers, pending_updates))
+        checkpoint.save(next_index)
+    except BaseException:
+        # Errore di rete/Sheets o runner terminato: le righe non scritte restano nel checkpoint (scrittura idempotente)
+        pipeline.close()
+        print(f"Interruzione inattesa: salvo il checkpoint all'indice {next_index} con {len(pending_updates)} righe in sospeso.")
+        checkpoint.save(next_index)
+        raise
+    finally:
+        # Anche in caso di timeout o interruzione: la partizione contiene le righe effettivamente scritte
+        write_cards_snapshot(user_slug, snapshot_rows)
+    if next_index < len(cards_to_process):
+        print(f"Timeout imminente. Stato salvato all'indice {next_index}.")
+        return False
     print("Esecuzione completata. Pulizia dello stato.")
-    if 'update_cards_continuation' in state: 
-        del state['update_cards_continuation']
-    save_state(state)
-    execution_time = time.time() - start_time
-    send_telegram_notification(f"✅ <b>Dati Carte Aggiornati (GitHub)</b>\\n\\n⏱️ Tempo: {execution_time:.2f}s")
-
-def update_sales():
-    print("--- INIZIO AGGIORNAMENTO CRONOLOGIA VENDITE (SOLUZIONE FORMATO STRINGA) ---")
-    start_time, state = time.time(), load_state()
-    continuation_data = state.get('update_sales_continuation', {})
-    start_index = continuation_data.get('last_index', 0)
+    checkpoint.clear()
+    execution_time = time.time() - gallery_start
     try:
-        credentials = json.loads(GSPREAD_CREDENTIALS_JSON)
-        gc = gspread.service_account_from_dict(credentials)
-        spreadsheet = gc.open_by_key(SPREADSHEET_ID)
-        main_sheet = spreadsheet.worksheet(MAIN_SHEET_NAME)
-        try:
-            sales_sheet = spreadsheet.worksheet(SALES_HISTORY_SHEET_NAME)
-        except gspread.WorksheetNotFound:
-            sales_sheet = None
+        trend = update_valuation_for(user_slug, sheet)
     except Exception as e:
-        print(f"ERRORE CRITICO GSheets: {e}")
-        return
-    
-    # Prepara gli header attesi
-    expected_headers = ["Player Name", "Player API Slug", "Rarity Searched", "Sales Today (In-Season)", "Sales Today (Classic)"]
-    periods = [3, 7, 14, 30]
-    for p in periods: 
-        expected_headers.extend([f"Avg Price {p}d (In-Season)", f"Avg Price {p}d (Classic)"])
-    for j in range(1, MAX_SALES_TO_DISPLAY + 1): 
-        expected_headers.extend([f"Sale {j} Date", f"Sale {j} Price (EUR)", f"Sale {j} Eligibility"])
-    expected_headers.append("Last Updated")
-    
+        print(f"Errore calcolo valutazione: {e}")
+        trend = ""
+    trend_msg = f"\\n{trend}" if trend else ""
+    send_telegram_notification(f"✅ <b>Dati Carte Aggiornati (GitHub)</b>{gallery_label(user_slug)}\\n\\n⏱️ Tempo: {execution_time:.2f}s{trend_msg}")
+    return True
+
+def sales_sheet_title(sheet_no):
+    """Nome del foglio vendite numero sheet_no: il primo mantiene il nome storico."""
+    return SALES_HISTORY_SHEET_NAME if sheet_no == 0 else f"{SALES_HISTORY_SHEET_NAME} {sheet_no + 1}"
+
+def list_sales_sheets(spreadsheet):
+    """Fogli della cronologia vendite presenti nello spreadsheet, {numero: worksheet}, con una sola lettura dei metadati."""
+    sheets = {}
+    for worksheet in spreadsheet.worksheets():
+        if worksheet.title == SALES_HISTORY_SHEET_NAME:
+            sheets[0] = worksheet
+            continue
+        match = re.fullmatch(re.escape(SALES_HISTORY_SHEET_NAME) + r" (\d+)", worksheet.title)
+        if match and int(match.group(1)) >= 2:
+            sheets[int(match.group(1)) - 1] = worksheet
+    return sheets
+
+def create_sales_sheet(spreadsheet, sheet_no, expected_headers):
+    """Crea un foglio vendite vuoto con gli header in grassetto e spazio per SALES_SHEET_MAX_ROWS righe."""
+    sales_sheet = spreadsheet.add_worksheet(
+        title=sales_sheet_title(sheet_no),
+        rows=max(1000, SALES_SHEET_MAX_ROWS + 1),
+        cols=len(expected_headers)
+    )
+    sales_sheet.update(range_name='A1', values=[expected_headers])
+    sales_sheet.format(f'A1:{column_letter(len(expected_headers))}1', {'textFormat': {'bold': True}})
+    print(f"✅ Nuovo foglio '{sales_sheet.title}' creato: {len(expected_headers)} colonne esatte")
+    return sales_sheet
+
+def prepare_sales_sheet(spreadsheet, sheet_no, sales_sheet, expected_headers):
+    """
+    Controllo salute di un singolo foglio vendite: sistema header/dimensioni se possibile,
+    altrimenti lo ricrea (perdendo solo le righe di quel foglio). Ritorna (worksheet, ricreato);
+    worksheet è None se andrebbe ricreato ma siamo in modalità shard.
+    """
+    title = sales_sheet_title(sheet_no)
     num_expected_cols = len(expected_headers)
-    print(f"Colonne attese: {num_expected_cols}")
-    
-    # LOGICA INTELLIGENTE: Controlla salute del foglio
     sheet_needs_recreation = False
     
     if sales_sheet is None:
-        print("Foglio non esistente. Sarà creato.")
+        print(f"Foglio '{title}' non esistente. Sarà creato.")
         sheet_needs_recreation = True
     else:
-        print("Controllo salute del foglio esistente...")
+        print(f"Controllo salute del foglio '{title}'...")
         is_healthy, needs_recreation, error_msg = check_sheet_health(sales_sheet, expected_headers)
         print(f"Stato foglio: {error_msg}")
         
@@ -677,8 +2030,7 @@ def update_sales():
                 
                 # Aggiorna header se necessario
                 sales_sheet.update(range_name='A1', values=[expected_headers])
-                header_range = f'A1:{chr(64 + min(num_expected_cols, 26))}1' if num_expected_cols <= 26 else f'A1:{chr(64 + (num_expected_cols-1)//26)}{chr(65 + ((num_expected_cols-1)%26))}1'
-                sales_sheet.format(header_range, {'textFormat': {'bold': True}})
+                sales_sheet.format(f'A1:{column_letter(num_expected_cols)}1', {'textFormat': {'bold': True}})
                 print("✅ Foglio sistemato senza ricreazione")
             except Exception as e:
                 print(f"❌ Sistemazione fallita: {e}. Procedo con ricreazione.")
@@ -686,202 +2038,529 @@ def update_sales():
         else:
             print("✅ FOGLIO SANO: Uso logica database normale")
     
-    # RICREAZIONE FOGLIO (solo se necessario)
-    if sheet_needs_recreation:
-        print("🔄 RICREAZIONE FOGLIO IN CORSO...")
-        
-        # Elimina foglio esistente se presente
-        if sales_sheet:
-            try:
-                spreadsheet.del_worksheet(sales_sheet)
-                print("Foglio eliminato.")
-            except Exception as e:
-                print(f"Errore eliminazione: {e}")
-        
-        # Crea nuovo foglio
-        sales_sheet = spreadsheet.add_worksheet(
-            title=SALES_HISTORY_SHEET_NAME, 
-            rows=1000, 
-            cols=num_expected_cols
-        )
-        
-        # Aggiungi header
-        sales_sheet.update(range_name='A1', values=[expected_headers])
-        header_range = f'A1:{chr(64 + min(num_expected_cols, 26))}1' if num_expected_cols <= 26 else f'A1:{chr(64 + (num_expected_cols-1)//26)}{chr(65 + ((num_expected_cols-1)%26))}1'
-        sales_sheet.format(header_range, {'textFormat': {'bold': True}})
-        
-        print(f"✅ Nuovo foglio creato: {num_expected_cols} colonne esatte")
-        
-        # Reset continuation data since sheet is new
-        continuation_data = {'pairs_to_process': [], 'existing_sales_map': {}, 'last_index': 0}
+    if not sheet_needs_recreation:
+        return sales_sheet, False
+    # In modalità shard il foglio è condiviso: la ricreazione va fatta da un'esecuzione non shard
+    if SHARD_COUNT > 1:
+        print(f"❌ Il foglio '{title}' va creato/ricreato con un'esecuzione senza shard.")
+        return None, False
+
+    print(f"🔄 RICREAZIONE FOGLIO '{title}' IN CORSO...")
+    if sales_sheet:
+        try:
+            spreadsheet.del_worksheet(sales_sheet)
+            print("Foglio eliminato.")
+        except Exception as e:
+            print(f"Errore eliminazione: {e}")
+    return create_sales_sheet(spreadsheet, sheet_no, expected_headers), True
+
+def build_sales_routing(spreadsheet, sales_sheets):
+    """
+    Indice di instradamento {chiave coppia: [numero foglio, riga]} costruito leggendo solo le
+    colonne slug e rarità di tutti i fogli vendite, con un'unica values_batch_get.
+    """
+    slug_letter = column_letter(SALES_HISTORY_HEADERS.index("Player API Slug") + 1)
+    rarity_letter = column_letter(SALES_HISTORY_HEADERS.index("Rarity Searched") + 1)
+    sheet_numbers = sorted(sales_sheets)
+    ranges = []
+    for sheet_no in sheet_numbers:
+        title = sales_sheets[sheet_no].title
+        ranges.append(gspread.utils.absolute_range_name(title, f"{slug_letter}2:{slug_letter}"))
+        ranges.append(gspread.utils.absolute_range_name(title, f"{rarity_letter}2:{rarity_letter}"))
+    value_ranges = spreadsheet.values_batch_get(ranges).get('valueRanges', []) if ranges else []
+    routing = {}
+    for n, sheet_no in enumerate(sheet_numbers):
+        slugs = value_ranges[2 * n].get('values', [])
+        rarities = value_ranges[2 * n + 1].get('values', [])
+        for i, (slug_cell, rarity_cell) in enumerate(zip(slugs, rarities)):
+            if slug_cell and rarity_cell:
+                routing.setdefault(f"{slug_cell[0]}::{rarity_cell[0]}", [sheet_no, i + 2])
+    return routing
+
+def load_sales_rows(spreadsheet, sales_sheets, routing, keys, loaded_rows):
+    """Carica in loaded_rows le righe intere delle coppie indicate, solo dai fogli che le contengono (una values_batch_get)."""
+    keys = [key for key in keys if key in routing and key not in loaded_rows]
+    if not keys:
+        return
+    last_letter = column_letter(len(SALES_HISTORY_HEADERS))
+    ranges = []
+    for key in keys:
+        sheet_no, row_index = routing[key]
+        ranges.append(gspread.utils.absolute_range_name(sales_sheets[sheet_no].title, f"A{row_index}:{last_letter}{row_index}"))
+    value_ranges = spreadsheet.values_batch_get(ranges).get('valueRanges', [])
+    for key, value_range in zip(keys, value_ranges):
+        values = value_range.get('values', [])
+        loaded_rows[key] = SalesRow.from_sheet_values(values[0] if values else [], SALES_HISTORY_HEADERS)
+
+def appended_first_row(response):
+    """Prima riga scritta da append_rows, dal campo updates.updatedRange della risposta (es. "'Vendite'!A12:LB14") o None."""
+    updated_range = ((response or {}).get('updates') or {}).get('updatedRange', '')
+    match = re.search(r"!\$?[A-Z]+\$?(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+def sales_sheet_key_rows(sales_sheet, headers):
+    """{chiave coppia: riga} di un foglio vendite, letto dalle sole colonne slug e rarità."""
+    key_rows = {}
+    for row_index, slug, rarity in read_sheet_columns(sales_sheet, ["Player API Slug", "Rarity Searched"], headers):
+        key_rows.setdefault(f"{slug}::{rarity}", row_index)
+    return key_rows
+
+def flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, routing=None):
+    """
+    Applica il buffer di scritture dei fogli vendite e lo svuota. Gli aggiornamenti di tutti i
+    fogli coinvolti partono in un'unica values_batch_update e sono sovrascritture (idempotenti);
+    le righe nuove vengono accodate foglio per foglio, saltando quelle la cui coppia è già
+    presente nel foglio (accodate prima di un crash), così la ripresa non crea duplicati.
+    Se è indicato routing, vi registra la riga reale di ogni coppia accodata: quella della
+    risposta di append_rows, o quella già presente nel foglio per le coppie saltate.
+    """
+    if updates_to_batch or new_rows_to_append:
+        fence("sales_sheet")
+    if updates_to_batch:
+        print(f"📝 Aggiornamento {len(updates_to_batch)} righe esistenti...")
+        spreadsheet.values_batch_update({
+            'valueInputOption': 'USER_ENTERED',
+            'data': [
+                # Checkpoint del vecchio formato senza numero di foglio: erano tutte del primo foglio
+                {'range': gspread.utils.absolute_range_name(sales_sheets[update.get('sheet', 0)].title, update['range']), 'values': update['values']}
+                for update in updates_to_batch
+            ]
+        })
+    if new_rows_to_append:
+        slug_idx, rarity_idx = headers.index("Player API Slug"), headers.index("Rarity Searched")
+        rows_by_sheet = {}
+        for item in new_rows_to_append:
+            sheet_no, row = (item['sheet'], item['values']) if isinstance(item, dict) else (0, item)
+            rows_by_sheet.setdefault(sheet_no, []).append(row)
+        for sheet_no, sheet_rows in sorted(rows_by_sheet.items()):
+            sales_sheet = sales_sheets[sheet_no]
+            present = sales_sheet_key_rows(sales_sheet, headers)
+            rows = [row for row in sheet_rows if f"{row[slug_idx]}::{row[rarity_idx]}" not in present]
+            if routing is not None:
+                for row in sheet_rows:
+                    key = f"{row[slug_idx]}::{row[rarity_idx]}"
+                    if key in present:
+                        routing[key] = [sheet_no, present[key]]
+            if rows:
+                print(f"➕ Aggiunta {len(rows)} nuove righe in '{sales_sheet.title}'...")
+                response = sales_sheet.append_rows(rows, value_input_option='USER_ENTERED')
+                if routing is not None:
+                    first_row = appended_first_row(response)
+                    if first_row is None:
+                        # Risposta senza intervallo: si rilegge dove sono finite le coppie
+                        present = sales_sheet_key_rows(sales_sheet, headers)
+                        for row in rows:
+                            key = f"{row[slug_idx]}::{row[rarity_idx]}"
+                            if key in present:
+                                routing[key] = [sheet_no, present[key]]
+                    else:
+                        for offset, row in enumerate(rows):
+                            routing[f"{row[slug_idx]}::{row[rarity_idx]}"] = [sheet_no, first_row + offset]
+    updates_to_batch.clear()
+    new_rows_to_append.clear()
+
+def update_sales():
+    start_time = time.time()
+    start_alerts("sales", SALES_HISTORY_HEADERS, "Rarity Searched")
+    try:
+        for user_slug, spreadsheet_id in get_galleries():
+            # Budget di tempo condiviso tra le gallerie, come in update_cards
+            if not with_leases(spreadsheet_id, ["sales_sheet"], update_sales_for, user_slug, spreadsheet_id, start_time):
+                break
+    finally:
+        finish_alerts("sales", "Alert Vendite")
+
+def update_sales_for(user_slug, spreadsheet_id, start_time):
+    """Aggiorna la cronologia vendite di una galleria. Ritorna False se il budget di tempo è esaurito."""
+    print(f"--- INIZIO AGGIORNAMENTO CRONOLOGIA VENDITE (SOLUZIONE FORMATO STRINGA){gallery_label(user_slug)} ---")
+    gallery_start, state = time.time(), load_state()
+    state_key = gallery_state_key('update_sales_continuation', user_slug)
+    continuation_data = state.get(state_key, {})
+    start_index = continuation_data.get('last_index', 0)
+    try:
+        spreadsheet = get_gspread_client().open_by_key(spreadsheet_id)
+        main_sheet = spreadsheet.worksheet(MAIN_SHEET_NAME)
+        sales_sheets = list_sales_sheets(spreadsheet)
+    except Exception as e:
+        print(f"ERRORE CRITICO GSheets: {e}")
+        return True
+    
+    expected_headers = SALES_HISTORY_HEADERS
+    print(f"Colonne attese: {len(expected_headers)}")
+    
+    # LOGICA INTELLIGENTE: Controlla salute di ogni foglio (il primo viene creato se manca)
+    recreated_sheets = []
+    for sheet_no in sorted(set(sales_sheets) | {0}):
+        sales_sheet, recreated = prepare_sales_sheet(spreadsheet, sheet_no, sales_sheets.get(sheet_no), expected_headers)
+        if sales_sheet is None:
+            print("Salto la galleria.")
+            return True
+        sales_sheets[sheet_no] = sales_sheet
+        if recreated:
+            recreated_sheets.append(sheet_no)
+    
+    if recreated_sheets:
+        # Le righe sono cambiate: piano e buffer vanno ricostruiti
+        continuation_data = {}
         start_index = 0
     
+    # Il buffer di scritture fa parte della continuazione: viene salvato con ogni checkpoint
+    pending_writes = continuation_data.setdefault('pending_writes', {'updates': [], 'appends': []})
+    updates_to_batch = pending_writes['updates']
+    new_rows_to_append = pending_writes['appends']
+    headers = expected_headers
+    if updates_to_batch or new_rows_to_append:
+        # Prima di tutto il resto: l'indice di instradamento deve vedere anche queste righe
+        print(f"Ripresa: applico {len(updates_to_batch) + len(new_rows_to_append)} scritture in sospeso dal checkpoint...")
+        flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, continuation_data.get('sales_routing'))
+    
     # LOGICA DATABASE NORMALE
-    if start_index == 0:
+    if 'pairs_to_process' not in continuation_data:
         print("Preparazione dati per aggiornamento database...")
-        main_records = main_sheet.get_all_records()
         pairs_map = {}
-        for record in main_records:
-            slug, rarity = record.get("Player API Slug"), record.get("Rarity")
+        for _, slug, rarity, name in read_sheet_columns(main_sheet, ["Player API Slug", "Rarity", "Player Name"]):
             if slug and rarity:
                 key = f"{slug}::{rarity.lower()}"
-                if key not in pairs_map: 
-                    pairs_map[key] = {"slug": slug, "rarity": rarity.lower(), "name": record.get("Player Name")}
+                if key not in pairs_map and in_current_shard(key): 
+                    pairs_map[key] = {"slug": slug, "rarity": rarity.lower(), "name": name}
         continuation_data['pairs_to_process'] = list(pairs_map.values())
-        
-        # Leggi dati esistenti se il foglio non è stato ricreato
-        if not sheet_needs_recreation:
-            print("Lettura storico vendite esistente...")
-            try:
-                existing_records = sales_sheet.get_all_records()
-                continuation_data['existing_sales_map'] = { 
-                    f"{rec.get('Player API Slug')}::{rec.get('Rarity Searched')}": 
-                    {"row_index": i + 2, "record": rec} 
-                    for i, rec in enumerate(existing_records) 
-                }
-                print(f"Trovate {len(existing_records)} righe esistenti nel database")
-            except Exception as e:
-                print(f"Errore lettura storico: {e}")
-                continuation_data['existing_sales_map'] = {}
-        else:
-            continuation_data['existing_sales_map'] = {}
+    
+    if 'sales_routing' not in continuation_data:
+        continuation_data.pop('existing_sales_map', None)  # Formato precedente: righe intere nel checkpoint
+        # Solo le colonne chiave: le righe intere si leggono a blocchi durante l'elaborazione
+        print(f"Lettura indice vendite da {len(sales_sheets)} fogli...")
+        try:
+            continuation_data['sales_routing'] = build_sales_routing(spreadsheet, sales_sheets)
+        except Exception as e:
+            # Senza indice le coppie esistenti verrebbero accodate di nuovo in un altro foglio
+            print(f"Errore lettura indice vendite: {e}. Salto la galleria.")
+            return True
+        print(f"Trovate {len(continuation_data['sales_routing'])} righe esistenti nel database")
     
     pairs_to_process = continuation_data.get('pairs_to_process', [])
-    existing_sales_map = continuation_data.get('existing_sales_map', {})
-    updates_to_batch = []
-    new_rows_to_append = []
-    headers = expected_headers
+    sales_routing = continuation_data['sales_routing']
+    checkpoint = Checkpointer(state, state_key, continuation_data)
+    checkpoint.save(start_index)
+    
+    # Ultima riga usata per foglio: le coppie nuove vanno nel primo foglio che ha ancora posto
+    last_rows = {sheet_no: 1 for sheet_no in sales_sheets}
+    for sheet_no, row_index in sales_routing.values():
+        last_rows[sheet_no] = max(last_rows.get(sheet_no, 1), row_index)
+    loaded_rows = {}
 
-    print(f"Processamento: {len(pairs_to_process)} coppie giocatore-rarità")
+    print(f"Processamento: {len(pairs_to_process)} coppie giocatore-rarità su {len(sales_sheets)} fogli")
+    batch_attempted = set()
+    # Snapshot in formato lungo: solo le vendite più recenti del watermark di ogni coppia
+    watermark_key = gallery_state_key(SALES_SNAPSHOT_STATE_KEY, user_slug)
+    sales_watermarks, new_watermarks, snapshot_sales = state.get(watermark_key, {}), {}, []
     
-    for i in range(start_index, len(pairs_to_process)):
-        if time.time() - start_time > 480: # 8 minuti timeout
-            print(f"⏰ Timeout imminente. Salvo stato all'indice {i}.")
-            continuation_data['last_index'] = i
-            state['update_sales_continuation'] = continuation_data
-            save_state(state)
-            if updates_to_batch: 
-                sales_sheet.batch_update(updates_to_batch, value_input_option='USER_ENTERED')
-            if new_rows_to_append: 
-                sales_sheet.append_rows(new_rows_to_append, value_input_option='USER_ENTERED')
-            return
-        
-        pair = pairs_to_process[i]
-        key = f"{pair['slug']}::{pair['rarity']}"
-        print(f"📊 ({i+1}/{len(pairs_to_process)}): {pair['name']} ({pair['rarity']})")
-        
-        existing_info = existing_sales_map.get(key)
-        sales_to_fetch = MAX_SALES_FROM_API if existing_info else INITIAL_SALES_FETCH_COUNT
-        
-        # Fetch nuove vendite dall'API
-        api_data = sorare_graphql_fetch(PLAYER_TOKEN_PRICES_QUERY, {
-            "playerSlug": pair['slug'], 
-            "rarity": pair['rarity'], 
-            "limit": sales_to_fetch
-        })
+    i = start_index
+    try:
+        for i in range(start_index, len(pairs_to_process)):
+            if time.time() - start_time > 480: # 8 minuti timeout
+                print(f"⏰ Timeout imminente. Salvo stato all'indice {i}.")
+                checkpoint.save(i)
+                flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, sales_routing)
+                checkpoint.save(i)
+                return False
+            checkpoint.tick(i)
+            
+            pair = pairs_to_process[i]
+            key = f"{pair['slug']}::{pair['rarity']}"
+            print(f"📊 ({i+1}/{len(pairs_to_process)}): {pair['name']} ({pair['rarity']})")
         
-        new_sales_from_api = []
-        if api_data and api_data.get("data") and not api_data.get("errors"):
-            for sale in api_data["data"].get("tokens", {}).get("tokenPrices", []):
-                # CORREZIONE CRITICA BUG CACHE: SALVA SEMPRE IL PREZZO GIÀ CONVERTITO
-                api_price_eur = sale['amounts']['eurCents'] / 100  # Convertito qui
-                new_sales_from_api.append({
-                    "timestamp": datetime.strptime(sale['date'], "%Y-%m-%dT%H:%M:%SZ").timestamp() * 1000, 
-                    "price": api_price_eur,  # SALVATO GIÀ IN EUR NELLA CACHE
-                    "seasonEligibility": "IN_SEASON" if sale['card']['inSeasonEligible'] else "CLASSIC"
-                })
-                if len(new_sales_from_api) <= 3:  # Debug log
-                    print(f"  🆕 API (cache): {api_price_eur} EUR (da {sale['amounts']['eurCents']} cents)")
+            existing_info = sales_routing.get(key)
+            sales_to_fetch = MAX_SALES_FROM_API if existing_info else INITIAL_SALES_FETCH_COUNT
+            if key not in batch_attempted:
+                # Le prossime BATCH_SIZE coppie in un'unica richiesta con alias (quelle fallite vanno poi singolarmente)
+                batch = [p for p in pairs_to_process[i:i + BATCH_SIZE] if f"{p['slug']}::{p['rarity']}" not in batch_attempted]
+                batch_attempted.update(f"{p['slug']}::{p['rarity']}" for p in batch)
+                prefetch_token_prices([
+                    (p['slug'], p['rarity'], MAX_SALES_FROM_API if f"{p['slug']}::{p['rarity']}" in sales_routing else INITIAL_SALES_FETCH_COUNT)
+                    for p in batch
+                ])
+                # Righe esistenti dello stesso blocco, lette solo dai fogli che le contengono
+                load_sales_rows(spreadsheet, sales_sheets, sales_routing, [f"{p['slug']}::{p['rarity']}" for p in batch], loaded_rows)
         
-        # Recupera vendite esistenti dal foglio CON CORREZIONE AUTOMATICA
-        old_sales_from_sheet = []
-        if existing_info:
-            record = existing_info['record']
-            print(f"  📄 Leggo vendite esistenti dal foglio...")
-            
-            # Estrai i prezzi API per il confronto
-            api_prices_for_comparison = [s['price'] for s in new_sales_from_api]
-            
-            for j in range(1, MAX_SALES_TO_DISPLAY + 1):
-                date_str, price_val = record.get(f"Sale {j} Date"), record.get(f"Sale {j} Price (EUR)")
-                if date_str and price_val:
-                    raw_price = parse_price(price_val)  # parse_price restituisce il valore raw dal foglio
-                    if raw_price is not None:
-                        # CORREZIONE AUTOMATICA: Confronta con i prezzi API
-                        corrected_price = smart_price_correction(raw_price, api_prices_for_comparison)
-                        
-                        try:
-                            timestamp = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S').timestamp() * 1000
-                            eligibility = record.get(f"Sale {j} Eligibility")
-                            old_sales_from_sheet.append({
-                                "timestamp": timestamp, 
-                                "price": corrected_price,  # USA IL PREZZO CORRETTO
-                                "seasonEligibility": eligibility
-                            })
-                            if j <= 3:  # Debug log
-                                correction_note = " (corretto)" if corrected_price != raw_price else ""
-                                print(f"  📄 Foglio Sale {j}: {corrected_price} EUR{correction_note}")
-                        except (ValueError, TypeError):
-                            continue
+            # Fetch nuove vendite dall'API (condivise tra le gallerie)
+            new_sales_from_api = fetch_token_prices(pair['slug'], pair['rarity'], sales_to_fetch) or []
+            for sale in new_sales_from_api[:3]:  # Debug log
+                print(f"  🆕 API (cache): {sale['price']} EUR")
         
-        # Combina e deduplica vendite
-        print(f"  🔄 Combinazione: {len(new_sales_from_api)} nuove + {len(old_sales_from_sheet)} esistenti")
-        all_sales = new_sales_from_api + old_sales_from_sheet
-        unique_sales = {int(s['timestamp']): s for s in all_sales}  # Dedup by timestamp
-        combined_sales = sorted(unique_sales.values(), key=lambda x: x['timestamp'], reverse=True)[:MAX_SALES_TO_DISPLAY]
+            # Recupera vendite esistenti dal foglio CON CORREZIONE AUTOMATICA
+            old_sales_from_sheet = []
+            if existing_info:
+                print(f"  📄 Leggo vendite esistenti dal foglio...")
+                load_sales_rows(spreadsheet, sales_sheets, sales_routing, [key], loaded_rows)
+                row = loaded_rows.pop(key)
+                # Estrai i prezzi API per il confronto
+                api_prices_for_comparison = [s['price'] for s in new_sales_from_api]
+                old_sales_from_sheet = parse_sheet_sales(row.values, api_prices_for_comparison)
         
-        print(f"  ✅ Risultato finale: {len(combined_sales)} vendite uniche")
+            # Combina e deduplica vendite
+            print(f"  🔄 Combinazione: {len(new_sales_from_api)} nuove + {len(old_sales_from_sheet)} esistenti")
+            all_sales = new_sales_from_api + old_sales_from_sheet
+            unique_sales = {int(s['timestamp']): s for s in all_sales}  # Dedup by timestamp
+            combined_sales = sorted(unique_sales.values(), key=lambda x: x['timestamp'], reverse=True)[:MAX_SALES_TO_DISPLAY]
         
-        # 🚀 CREA RIGA AGGIORNATA CON FORMATTAZIONE STRINGA
-        updated_row = build_sales_history_row(pair['name'], pair['slug'], pair['rarity'], combined_sales, headers)
+            print(f"  ✅ Risultato finale: {len(combined_sales)} vendite uniche")
+            watermark = sales_watermarks.get(key, 0)
+            fresh_sales = [s for s in combined_sales if s['timestamp'] > watermark]
+            if fresh_sales:
+                snapshot_sales.extend((pair['slug'], pair['rarity'], int(s['timestamp']), s['price'], s['seasonEligibility']) for s in fresh_sales)
+                new_watermarks[key] = max(s['timestamp'] for s in fresh_sales)
         
-        # Aggiungi all'aggiornamento o nuova riga
-        if existing_info:
-            updates_to_batch.append({'range': f'A{existing_info["row_index"]}', 'values': [updated_row]})
-        else:
-            new_rows_to_append.append(updated_row)
-            # Calcola la prossima row_index disponibile per future reference
-            next_row = len(existing_sales_map) + len(new_rows_to_append) + 2  # +1 for header, +1 for 1-based indexing
-            existing_sales_map[key] = {'row_index': next_row, 'record': {}}
+            # 🚀 CREA RIGA AGGIORNATA CON FORMATTAZIONE STRINGA
+            updated_row = build_sales_history_row(pair['name'], pair['slug'], pair['rarity'], combined_sales)
+            observe_alerts("sales", key, row.values if existing_info else None, updated_row)
         
-        time.sleep(1)
-    
-    # Applica aggiornamenti
-    if updates_to_batch:
-        print(f"📝 Aggiornamento {len(updates_to_batch)} righe esistenti...")
-        sales_sheet.batch_update(updates_to_batch, value_input_option='USER_ENTERED')
+            # Aggiungi all'aggiornamento o nuova riga
+            if existing_info:
+                sheet_no, row_index = existing_info
+                updates_to_batch.append({'sheet': sheet_no, 'range': f'A{row_index}', 'values': [updated_row]})
+            else:
+                # Il primo foglio con posto (anche uno appena ricreato), altrimenti se ne apre uno nuovo
+                sheet_no = next((n for n in sorted(sales_sheets) if last_rows[n] - 1 < SALES_SHEET_MAX_ROWS), max(sales_sheets))
+                if last_rows[sheet_no] - 1 >= SALES_SHEET_MAX_ROWS:
+                    if SHARD_COUNT > 1:
+                        # I fogli sono condivisi tra gli shard: un nuovo foglio lo apre solo un'esecuzione senza shard
+                        print(f"  ⚠️ Foglio '{sales_sheets[sheet_no].title}' pieno: accodo comunque (modalità shard)")
+                    else:
+                        flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, sales_routing)
+                        sheet_no += 1
+                        sales_sheets[sheet_no] = create_sales_sheet(spreadsheet, sheet_no, expected_headers)
+                        last_rows[sheet_no] = 1
+                last_rows[sheet_no] += 1
+                # La riga reale entra in sales_routing solo quando flush_sales_buffer l'ha scritta
+                new_rows_to_append.append({'sheet': sheet_no, 'values': updated_row})
     
-    if new_rows_to_append:
-        print(f"➕ Aggiunta {len(new_rows_to_append)} nuove righe...")
-        sales_sheet.append_rows(new_rows_to_append, value_input_option='USER_ENTERED')
+            # Niente pausa fissa per coppia: le chiamate API passano da SORARE_RATE_LIMITER
+            if len(updates_to_batch) + len(new_rows_to_append) >= SALES_FLUSH_EVERY_ROWS:
+                flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, sales_routing)
+                checkpoint.save(i + 1)
+        
+        # Applica aggiornamenti
+        i = len(pairs_to_process)
+        checkpoint.save(i)
+        flush_sales_buffer(spreadsheet, sales_sheets, headers, updates_to_batch, new_rows_to_append, sales_routing)
+    except BaseException:
+        # Il buffer non ancora scritto resta nel checkpoint e verrà applicato alla ripresa
+        print(f"Interruzione inattesa: salvo il checkpoint all'indice {i} con {len(updates_to_batch) + len(new_rows_to_append)} scritture in sospeso.")
+        checkpoint.save(i)
+        raise
+    finally:
+        # I watermark avanzano solo se la partizione è stata scritta: altrimenti le vendite verranno riemesse
+        try:
+            if write_snapshot_partition("sales", user_slug, SALES_SNAPSHOT_FIELDS, snapshot_sales) and new_watermarks:
+                state[watermark_key] = {**sales_watermarks, **new_watermarks}
+                save_state(state)
+        except Exception as e:
+            print(f"Errore scrittura snapshot vendite: {e}")
     
     # Cleanup
     print("✅ Aggiornamento database completato con formato stringa forzato!")
-    if 'update_sales_continuation' in state: 
-        del state['update_sales_continuation']
-    save_state(state)
+    checkpoint.clear()
     
-    execution_time = time.time() - start_time
-    recreation_msg = " (Foglio ricreato)" if sheet_needs_recreation else " (Database aggiornato)"
-    send_telegram_notification(f"✅ <b>Cronologia Vendite Aggiornata</b>{recreation_msg}\\n\\n⏱️ Tempo: {execution_time:.2f}s\\n📊 {len(pairs_to_process)} giocatori processati\\n🚀 Formato stringa applicato")
+    execution_time = time.time() - gallery_start
+    if recreated_sheets:
+        recreation_msg = f" (Ricreati: {', '.join(sales_sheet_title(n) for n in recreated_sheets)})"
+    else:
+        recreation_msg = " (Database aggiornato)"
+    send_telegram_notification(f"✅ <b>Cronologia Vendite Aggiornata</b>{gallery_label(user_slug)}{recreation_msg}\\n\\n⏱️ Tempo: {execution_time:.2f}s\\n📊 {len(pairs_to_process)} giocatori processati su {len(sales_sheets)} fogli\\n🚀 Formato stringa applicato")
+    return True
+
+def compute_portfolio_valuation(sheet):
+    """
+    Valore del portafoglio in centesimi, totale e per rarità, calcolato per colonne (pyarrow.compute)
+    sulle colonne lette con un'unica batch_get. Ogni carta vale il floor della sua rarità (in season
+    se la carta è in season e il floor esiste, altrimenti classic); le unique non hanno floor.
+    """
+    floor_columns = [column for pair in VALUATION_RARITY_FLOORS.values() for column in pair]
+    rows = read_sheet_columns(sheet, ["Rarity", "In Season?"] + floor_columns)
+    pa = import_pyarrow()
+    if pa is None:
+        return valuation_from_rows(rows, floor_columns)
+    import pyarrow.compute as pc
+    rarity = pc.utf8_lower(pa.array([str(row[1]) for row in rows], type=pa.string()))
+    in_season = pc.equal(pa.array([row[2] for row in rows], type=pa.string()), "Sì")
+    floors = {column: pa.array([parse_price(row[3 + j]) for row in rows], type=pa.float64()) for j, column in enumerate(floor_columns)}
+    has_card = pc.not_equal(rarity, "")
+    values = {"total": 0, "cards": pc.sum(pc.cast(has_card, pa.int64())).as_py() or 0, "unvalued": 0}
+    valued = 0
+    for rarity_name, (classic_column, in_season_column) in VALUATION_RARITY_FLOORS.items():
+        use_in_season = pc.and_(in_season, pc.is_valid(floors[in_season_column]))
+        floor = pc.if_else(use_in_season, floors[in_season_column], floors[classic_column])
+        cents = pc.cast(pc.round(pc.multiply(floor, 100)), pa.int64())
+        selected = pc.filter(cents, pc.fill_null(pc.equal(rarity, rarity_name), False))
+        values[rarity_name] = pc.sum(selected).as_py() or 0
+        values["total"] += values[rarity_name]
+        valued += len(selected) - selected.null_count
+    values["unvalued"] = values["cards"] - valued
+    return values
+
+def valuation_from_rows(rows, floor_columns):
+    """Stessa valutazione di compute_portfolio_valuation, riga per riga, quando pyarrow non è installato."""
+    values = {"total": 0, "cards": 0, "unvalued": 0}
+    values.update({rarity: 0 for rarity in VALUATION_RARITY_FLOORS})
+    for row in rows:
+        rarity, in_season, floors = str(row[1]).lower(), row[2] == "Sì", dict(zip(floor_columns, row[3:]))
+        if not rarity:
+            continue
+        values["cards"] += 1
+        if rarity not in VALUATION_RARITY_FLOORS:
+            values["unvalued"] += 1
+            continue
+        classic_column, in_season_column = VALUATION_RARITY_FLOORS[rarity]
+        floor = parse_price(floors[in_season_column]) if in_season else None
+        if floor is None:
+            floor = parse_price(floors[classic_column])
+        if floor is None:
+            values["unvalued"] += 1
+            continue
+        cents = int(round(floor * 100))
+        values[rarity] += cents
+        values["total"] += cents
+    return values
+
+def read_valuation_history(user_slug, index):
+    """
+    Ricostruisce lo storico recente [(timestamp, valori)] di una galleria sommando le differenze ai
+    fotogrammi. index ({"keyframes": [[t, offset], ...], "since": voci dopo l'ultimo fotogramma},
+    salvato nello stato) fa partire la lettura dall'ultimo fotogramma che copre
+    VALUATION_TREND_WINDOW_SECONDS invece che dall'inizio del file; viene aggiornato. Senza indice
+    valido (primo giro, file sostituito) si rilegge tutto una volta e l'indice viene ricostruito.
+    """
+    keyframes = index.get("keyframes") or []
+    cutoff = time.time() - VALUATION_TREND_WINDOW_SECONDS
+    start = next((offset for t, offset in reversed(keyframes) if t <= cutoff), keyframes[0][1] if keyframes else 0)
+    history = decode_valuation_history(user_slug, start, index)
+    if history is None:
+        print("AVVISO: indice dello storico valutazioni non valido, rileggo tutto il file.")
+        history = decode_valuation_history(user_slug, 0, index)
+    return history or []
+
+def decode_valuation_history(user_slug, offset, index):
+    """Decodifica le voci della galleria a partire da offset (inizio di un suo fotogramma). None se offset non lo è."""
+    history, current, keyframes, since = [], None, [], 0
+    try:
+        with open(VALUATION_HISTORY_FILE, "rb") as f:
+            f.seek(offset)
+            while True:
+                position, line = f.tell(), f.readline()
+                if not line:
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict) or entry.get("g") != user_slug:
+                    continue
+                if "k" in entry:
+                    current, since = dict(entry["k"]), 0
+                    keyframes.append([entry["t"], position])
+                elif current is not None:
+                    current = dict(current)
+                    for key, delta in entry.get("d", {}).items():
+                        current[key] = current.get(key, 0) + delta
+                    since += 1
+                else:
+                    continue  # Differenza senza fotogramma precedente: non ricostruibile
+                history.append((entry["t"], current))
+    except FileNotFoundError:
+        pass
+    if offset and (not keyframes or keyframes[0][1] != offset):
+        return None
+    index["keyframes"], index["since"] = keyframes, since
+    return history
+
+def append_valuation(user_slug, values, history, index):
+    """Accoda la valutazione: fotogramma completo se serve, altrimenti solo le chiavi cambiate (nulla se nulla è cambiato)."""
+    entry = {"t": int(time.time()), "g": user_slug}
+    if not history or index.get("since", 0) >= VALUATION_KEYFRAME_EVERY - 1:
+        entry["k"] = values
+    else:
+        previous = history[-1][1]
+        delta = {key: value - previous.get(key, 0) for key, value in values.items() if value != previous.get(key, 0)}
+        if not delta:
+            return False
+        entry["d"] = delta
+    with open(VALUATION_HISTORY_FILE, "ab") as f:
+        position = f.tell()
+        f.write((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+    if "k" in entry:
+        index.setdefault("keyframes", []).append([entry["t"], position])
+        index["since"] = 0
+    else:
+        index["since"] = index.get("since", 0) + 1
+    history.append((entry["t"], values))
+    return True
+
+def valuation_trend_summary(history):
+    """Riga di riepilogo per Telegram: valore attuale e variazione rispetto a ultimo giro, 24 ore e 7 giorni."""
+    if not history:
+        return ""
+    now_t, current = history[-1]
+    def value_at(seconds_ago):
+        candidates = [values for t, values in history if t <= now_t - seconds_ago]
+        return candidates[-1] if candidates else None
+    parts = []
+    for label, reference in (("prec.", history[-2][1] if len(history) > 1 else None), ("24h", value_at(86400)), ("7g", value_at(VALUATION_TREND_WINDOW_SECONDS))):
+        if reference is None or not reference.get("total"):
+            continue
+        delta = current["total"] - reference["total"]
+        arrow = "▲" if delta > 0 else "▼" if delta < 0 else "="
+        parts.append(f"{arrow} {delta / 100:+.2f} EUR ({delta / reference['total'] * 100:+.1f}%) vs {label}")
+    per_rarity = ", ".join(f"{rarity}: {current.get(rarity, 0) / 100:.2f}" for rarity in VALUATION_RARITY_FLOORS)
+    summary = f"💰 Valore portafoglio: {current['total'] / 100:.2f} EUR ({per_rarity})"
+    return summary + ("\\n" + "\\n".join(parts) if parts else "")
+
+def update_valuation_for(user_slug, sheet):
+    """Calcola la valutazione della galleria, la accoda allo storico e ritorna il riepilogo del trend."""
+    if SHARD_COUNT > 1:
+        return ""  # Ogni shard vede tutto il foglio: la valutazione la fa un'esecuzione non shard
+    values = compute_portfolio_valuation(sheet)
+    state = load_state()
+    index_key = gallery_state_key(VALUATION_INDEX_STATE_KEY, user_slug)
+    index = dict(state.get(index_key) or {})
+    history = read_valuation_history(user_slug, index)
+    append_valuation(user_slug, values, history, index)  # Se nulla è cambiato l'ultima voce ha già i valori attuali
+    state[index_key] = index
+    save_state(state)
+    return valuation_trend_summary(history)
+
+def update_valuation():
+    for user_slug, spreadsheet_id in get_galleries():
+        try:
+            sheet = get_gspread_client().open_by_key(spreadsheet_id).worksheet(MAIN_SHEET_NAME)
+        except Exception as e:
+            print(f"ERRORE CRITICO GSheets: {e}")
+            continue
+        summary = update_valuation_for(user_slug, sheet)
+        print(summary)
+        if summary:
+            send_telegram_notification(f"📈 <b>Valutazione Portafoglio</b>{gallery_label(user_slug)}\\n\\n{summary}")
 
 def update_floors():
     pass
 
 import urllib.parse
 
+def chart_labels(num_scores):
+    """Etichette dell'asse X: dalla più vecchia ('N° ultima') alla più recente ('Recente')."""
+    labels = []
+    if num_scores > 0:
+        for i in range(num_scores - 1):
+            labels.append(f'{num_scores - i}° ultima')
+        labels.append('Recente')
+    return labels
+
 def generate_chart_config(player_name, scores):
     """Generates a Chart.js configuration dictionary for a player's SO5 scores."""
     # Unzip the generated color tuples into two separate lists
     bg_colors, text_colors = zip(*[get_gradient_color(s) for s in scores])
 
     # Generate descriptive labels
-    num_scores = len(scores)
-    labels = []
-    if num_scores > 0:
-        for i in range(num_scores - 1):
-            labels.append(f'{num_scores - i}° ultima')
-        labels.append('Recente')
+    labels = chart_labels(len(scores))
 
     chart_config = {
         'type': 'bar',
@@ -941,13 +2620,85 @@ def generate_chart_config(player_name, scores):
     }
     return chart_config
 
+def parse_so5_scores(record):
+    """Estrae la lista dei punteggi SO5 (stringhe, DNP -> '0') da un record del foglio principale."""
+    # Check for new key first, then fall back to old key for backward compatibility
+    scores_str = str(record.get("Last 15 SO5 Scores") or record.get("Last 5 SO5 Scores") or "")
+    return [s.strip() if s.strip().upper() != 'DNP' else '0' for s in scores_str.split(',') if s.strip()]
+
+CHART_SOURCE_COLUMNS = ["Slug", "Player Name", "Last 15 SO5 Scores", "Last 5 SO5 Scores"]
+
+def read_chart_records(main_sheet):
+    """Legge dal foglio principale solo le colonne necessarie ai grafici."""
+    return [dict(zip(CHART_SOURCE_COLUMNS, row[1:])) for row in read_sheet_columns(main_sheet, CHART_SOURCE_COLUMNS)]
+
+def collect_chart_series(records):
+    """Ritorna {slug carta: (nome giocatore, punteggi dal più vecchio al più recente)}."""
+    charts = {}
+    for record in records:
+        slug = record.get("Slug")
+        scores = parse_so5_scores(record)
+        if slug and scores and slug not in charts:
+            # The API gives scores from most recent to least recent. We reverse for the chart to show recent on right.
+            charts[slug] = (record.get("Player Name"), scores[::-1])
+    return charts
+
+def chart_content_hash(player_name, scores):
+    """Hash del contenuto di un grafico: cambia solo se cambiano nome o serie dei punteggi."""
+    payload = json.dumps([player_name, scores], separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def build_chart_url(player_name, scores):
+    """Costruisce l'URL QuickChart.io con la configurazione Chart.js codificata."""
+    chart_config = generate_chart_config(player_name, scores)
+    config_str = json.dumps(chart_config, separators=(',', ':'))
+    encoded_config = urllib.parse.quote(config_str)
+    return f"https://quickchart.io/chart?w=500&h=300&bkg=transparent&c={encoded_config}"
+
+def setup_chart_sheet_layout(spreadsheet, chart_sheet):
+    """Pulisce il foglio dei grafici e ne imposta intestazioni, colonne e righe bloccate."""
+    chart_sheet.clear()
+    chart_sheet.update(range_name='A1:E1', values=[CHART_SHEET_HEADERS])
+    chart_sheet.format('A1:E1', {'textFormat': {'bold': True}})
+    spreadsheet.batch_update({
+        "requests": [
+            {"updateSheetProperties": {"properties": {"sheetId": chart_sheet.id, "gridProperties": {"frozenRowCount": 1}},"fields": "gridProperties.frozenRowCount"}},
+            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": 1}, "properties": {"pixelSize": 200}, "fields": "pixelSize"}},
+            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "COLUMNS", "startIndex": 1, "endIndex": 2}, "properties": {"pixelSize": 510}, "fields": "pixelSize"}},
+            # Slug e Hash servono solo allo script: colonne nascoste
+            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "COLUMNS", "startIndex": 3, "endIndex": 5}, "properties": {"hiddenByUser": True}, "fields": "hiddenByUser"}},
+        ]
+    })
+    print("Foglio dei grafici pulito e intestazioni scritte.")
+
 def create_so5_charts():
-    """Creates a new sheet with QuickChart.io chart images for each player."""
-    print("--- INIZIO CREAZIONE GRAFICI SO5 (QuickChart.io) ---")
+    for user_slug, spreadsheet_id in get_galleries():
+        create_so5_charts_for(user_slug, spreadsheet_id)
+
+def read_chart_index(chart_sheet):
+    """
+    Righe del foglio grafici ridotte a intestazione, nome, slug e hash, con un'unica batch_get:
+    gli URL dei grafici (colonna B, diversi KB per riga) non vengono scaricati. Le righe hanno il
+    formato di CHART_SHEET_HEADERS con le colonne B e C vuote.
+    """
+    header, names, keys = chart_sheet.batch_get(["A1:E1", "A2:A", "D2:E"])
+    rows = [list(header[0]) if header else []]
+    for i in range(max(len(names), len(keys))):
+        name = names[i][0] if i < len(names) and names[i] else ''
+        rows.append([name, '', ''] + list(keys[i] if i < len(keys) else []))
+    return rows
+
+def create_so5_charts_for(user_slug, spreadsheet_id):
+    """
+    Aggiorna il foglio con i grafici QuickChart.io di ogni carta in modo incrementale.
+
+    Ogni riga conserva (in colonne nascoste) lo slug della carta e l'hash della serie
+    di punteggi: vengono riscritte solo le righe cambiate, aggiunte o rimosse, le altre
+    restano al loro posto.
+    """
+    print(f"--- INIZIO CREAZIONE GRAFICI SO5 (QuickChart.io){gallery_label(user_slug)} ---")
     try:
-        credentials = json.loads(GSPREAD_CREDENTIALS_JSON)
-        gc = gspread.service_account_from_dict(credentials)
-        spreadsheet = gc.open_by_key(SPREADSHEET_ID)
+        spreadsheet = get_gspread_client().open_by_key(spreadsheet_id)
         main_sheet = spreadsheet.worksheet(MAIN_SHEET_NAME)
     except Exception as e:
         print(f"ERRORE CRITICO GSheets: {e}")
@@ -956,83 +2707,629 @@ def create_so5_charts():
     # Get or create the chart sheet
     try:
         chart_sheet = spreadsheet.worksheet(CHART_SHEET_NAME)
+        existing_rows = read_chart_index(chart_sheet)
     except gspread.WorksheetNotFound:
-        chart_sheet = spreadsheet.add_worksheet(title=CHART_SHEET_NAME, rows=1000, cols=5)
+        chart_sheet = spreadsheet.add_worksheet(title=CHART_SHEET_NAME, rows=1000, cols=len(CHART_SHEET_HEADERS))
+        existing_rows = []
         print(f"Foglio '{CHART_SHEET_NAME}' creato.")
 
-    chart_sheet.clear()
-    chart_sheet.update(range_name='A1:B1', values=[['Giocatore', 'Grafico Ultimi 5 Punteggi SO5']])
-    chart_sheet.format('A1:B1', {'textFormat': {'bold': True}})
-    print("Foglio dei grafici pulito e intestazioni scritte.")
+    # Layout vecchio (senza Slug/Hash) o foglio nuovo: ricostruzione completa una tantum
+    header_row = (existing_rows[0] + [''] * len(CHART_SHEET_HEADERS))[:len(CHART_SHEET_HEADERS)] if existing_rows else []
+    if header_row != CHART_SHEET_HEADERS:
+        print("Layout del foglio grafici non aggiornato: ricostruzione completa.")
+        setup_chart_sheet_layout(spreadsheet, chart_sheet)
+        existing_rows = []
+
+    # Righe esistenti: slug -> (riga, hash). Le righe vuote sono slot riutilizzabili.
+    existing_charts, free_rows, dirty_rows = {}, [], set()
+    for row_index, row in enumerate(existing_rows[1:], start=2):
+        row = row + [''] * (len(CHART_SHEET_HEADERS) - len(row))
+        slug, content_hash = row[3], row[4]
+        if slug and slug not in existing_charts:
+            existing_charts[slug] = (row_index, content_hash)
+            continue
+        free_rows.append(row_index)
+        if any(row):
+            dirty_rows.add(row_index)  # Riga duplicata o senza slug: va ripulita se non riusata
+    next_row = max(len(existing_rows), 1) + 1
 
     # Read player data from the main sheet
-    all_records = main_sheet.get_all_records()
-    players_with_scores = [
-        r for r in all_records if (r.get("Last 15 SO5 Scores", "") or r.get("Last 5 SO5 Scores", "")).strip()
-    ]
-    if not players_with_scores:
+    desired_charts = collect_chart_series(read_chart_records(main_sheet))
+    if not desired_charts and not existing_charts:
         print("Nessun giocatore con punteggi SO5 trovato.")
         return
 
-    print(f"Trovati {len(players_with_scores)} giocatori con punteggi SO5 da processare.")
+    print(f"Trovati {len(desired_charts)} giocatori con punteggi SO5 da processare.")
 
-    # Prepare data for batch update
     update_data = []
-    for i, player in enumerate(players_with_scores):
-        # Check for new key first, then fall back to old key for backward compatibility
-        scores_str = player.get("Last 15 SO5 Scores") or player.get("Last 5 SO5 Scores")
-        scores = [s.strip() if s.strip().upper() != 'DNP' else '0' for s in scores_str.split(',') if s.strip()]
-        if not scores:
+    removed_slugs = [slug for slug in existing_charts if slug not in desired_charts]
+    for slug in removed_slugs:
+        row_index = existing_charts[slug][0]
+        free_rows.append(row_index)
+        dirty_rows.add(row_index)
+    free_rows.sort()
+
+    changed, added, first_appended_row = 0, 0, None
+    for slug, (player_name, scores) in desired_charts.items():
+        content_hash = chart_content_hash(player_name, scores)
+        if slug in existing_charts:
+            row_index, old_hash = existing_charts[slug]
+            if old_hash == content_hash:
+                continue
+            changed += 1
+        else:
+            added += 1
+            if free_rows:
+                row_index = free_rows.pop(0)
+            else:
+                row_index, next_row = next_row, next_row + 1
+                first_appended_row = first_appended_row or row_index
+        chart_url = build_chart_url(player_name, scores)
+        update_data.append({'range': f'A{row_index}:E{row_index}', 'values': [[player_name, chart_url, '', slug, content_hash]]})
+    # Le righe liberate e non riassegnate vengono svuotate
+    for row_index in sorted(dirty_rows.intersection(free_rows)):
+        update_data.append({'range': f'A{row_index}:E{row_index}', 'values': [[''] * len(CHART_SHEET_HEADERS)]})
+
+    unchanged = len(desired_charts) - changed - added
+    print(f"Grafici: {added} nuovi, {changed} modificati, {len(removed_slugs)} rimossi, {unchanged} invariati.")
+    if not update_data:
+        print("--- NESSUN GRAFICO DA AGGIORNARE. ---")
+        return
+
+    # Assicura che la griglia abbia abbastanza righe per le righe accodate
+    if next_row - 1 > chart_sheet.row_count:
+        chart_sheet.add_rows(next_row - 1 - chart_sheet.row_count)
+
+    print(f"Scrittura di {len(update_data)} righe nel foglio...")
+    chart_sheet.batch_update(update_data, value_input_option='USER_ENTERED')
+
+    # Altezza solo per le righe nuove in coda, le altre sono già dimensionate
+    if first_appended_row:
+        spreadsheet.batch_update({
+            "requests": [
+                {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "ROWS", "startIndex": first_appended_row - 1, "endIndex": next_row - 1}, "properties": {"pixelSize": 310}, "fields": "pixelSize"}},
+            ]
+        })
+
+    print(f"--- CREAZIONE GRAFICI COMPLETATA. {added + changed} grafici scritti in '{CHART_SHEET_NAME}'. ---")
+
+# --- 5. RENDERING LOCALE DEI GRAFICI (senza QuickChart.io) ---
+def parse_rgba(color_str):
+    """Converte 'rgba(r, g, b, a)' nella tupla (r, g, b)."""
+    r, g, b = color_str[color_str.index('(') + 1:color_str.index(')')].split(',')[:3]
+    return int(r), int(g), int(b)
+
+def chart_layout(player_name, scores):
+    """
+    Calcola le primitive grafiche (rect/line/text) dello stesso grafico a barre di
+    generate_chart_config, così SVG e PNG condividono esattamente la stessa geometria.
+    """
+    width, height = CHART_WIDTH, CHART_HEIGHT
+    left, right, top, bottom = 40, 10, 40, 30
+    plot_w, plot_h = width - left - right, height - top - bottom
+    shapes = [('text', width / 2, 26, player_name or '', 18, (51, 51, 51), True)]
+
+    # Asse Y: 0-100 a passi di 20, come in Chart.js
+    for tick in range(0, 101, 20):
+        y = top + plot_h - plot_h * tick / 100
+        shapes.append(('line', left, y, left + plot_w, y, (230, 230, 230)))
+        shapes.append(('text', left - 6, y + 4, str(tick), 11, (85, 85, 85), False, 'end'))
+
+    labels = chart_labels(len(scores))
+    category_w = plot_w / max(len(scores), 1)
+    bar_w = category_w * 0.7 * 0.6
+    for i, score in enumerate(scores):
+        bg_color, text_color = get_gradient_color(score)
+        try:
+            value = float(score)
+        except (ValueError, TypeError):
+            value = 0.0
+        bar_h = plot_h * max(0.0, min(value, 100.0)) / 100
+        center_x = left + category_w * i + category_w / 2
+        bar_top = top + plot_h - bar_h
+        shapes.append(('rect', center_x - bar_w / 2, bar_top, bar_w, bar_h, parse_rgba(bg_color)))
+        # Stessa regola del formatter Chart.js: 0 -> ❌, altrimenti Math.round
+        label = '❌' if value == 0 else str(int(math.floor(value + 0.5)))
+        label_y = bar_top + bar_h / 2 + 6 if bar_h >= 20 else top + plot_h - 4
+        shapes.append(('text', center_x, label_y, label, 18 if len(scores) <= 10 else 12, (0, 0, 0) if text_color == 'black' else (255, 255, 255), True))
+        shapes.append(('text', center_x, top + plot_h + 16, labels[i], 10 if len(scores) <= 10 else 8, (85, 85, 85), False))
+    return shapes
+
+def render_chart_svg(player_name, scores, x=0, y=0):
+    """Rende il grafico come elemento <svg> autonomo (posizionabile con x/y in un contact sheet)."""
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" x="{x}" y="{y}" width="{CHART_WIDTH}" height="{CHART_HEIGHT}" viewBox="0 0 {CHART_WIDTH} {CHART_HEIGHT}" font-family="Helvetica, Arial, sans-serif">']
+    for shape in chart_layout(player_name, scores):
+        kind = shape[0]
+        if kind == 'rect':
+            _, rx, ry, rw, rh, (r, g, b) = shape
+            parts.append(f'<rect x="{rx:.1f}" y="{ry:.1f}" width="{rw:.1f}" height="{rh:.1f}" fill="rgb({r},{g},{b})" stroke="#000" stroke-opacity="0.3" stroke-width="1"/>')
+        elif kind == 'line':
+            _, x1, y1, x2, y2, (r, g, b) = shape
+            parts.append(f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" stroke="rgb({r},{g},{b})" stroke-width="1"/>')
+        else:
+            _, tx, ty, text, size, (r, g, b), bold = shape[:7]
+            anchor = shape[7] if len(shape) > 7 else 'middle'
+            weight = ' font-weight="bold"' if bold else ''
+            parts.append(f'<text x="{tx:.1f}" y="{ty:.1f}" font-size="{size}"{weight} fill="rgb({r},{g},{b})" text-anchor="{anchor}">{html.escape(text)}</text>')
+    parts.append('</svg>')
+    return '\n'.join(parts)
+
+def _load_png_font(size, bold):
+    from PIL import ImageFont
+    try:
+        return ImageFont.truetype("DejaVuSans-Bold.ttf" if bold else "DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default()
+
+def render_chart_png(player_name, scores, path):
+    """Rende il grafico in PNG con Pillow (dipendenza opzionale, importata solo qui)."""
+    from PIL import Image, ImageDraw
+    image = Image.new('RGBA', (CHART_WIDTH, CHART_HEIGHT), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(image)
+    for shape in chart_layout(player_name, scores):
+        kind = shape[0]
+        if kind == 'rect':
+            _, rx, ry, rw, rh, color = shape
+            draw.rectangle([rx, ry, rx + rw, ry + rh], fill=color, outline=(0, 0, 0, 77))
+        elif kind == 'line':
+            _, x1, y1, x2, y2, color = shape
+            draw.line([x1, y1, x2, y2], fill=color)
+        else:
+            _, tx, ty, text, size, color, bold = shape[:7]
+            anchor = 'rs' if len(shape) > 7 and shape[7] == 'end' else 'ms'
+            # I font di sistema non hanno l'emoji: per le PNG lo 0 è una X
+            draw.text((tx, ty), 'X' if text == '❌' else text, fill=color, font=_load_png_font(size, bold), anchor=anchor)
+    image.save(path)
+
+def chart_file_name(slug, fmt):
+    return f"{re.sub(r'[^A-Za-z0-9_.-]', '_', slug)}.{fmt}"
+
+def _render_chart_file(args):
+    """Worker del process pool: rende un singolo grafico su file e ritorna lo slug."""
+    slug, player_name, scores, output_dir, fmt = args
+    path = os.path.join(output_dir, chart_file_name(slug, fmt))
+    if fmt == 'png':
+        render_chart_png(player_name, scores, path)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(render_chart_svg(player_name, scores))
+    return slug
+
+def build_contact_sheet(charts, output_dir, fmt):
+    """Unisce tutti i grafici in un'unica immagine a griglia (contact sheet)."""
+    columns = CONTACT_SHEET_COLUMNS
+    slugs = sorted(charts)
+    rows = (len(slugs) + columns - 1) // columns
+    width, height = CHART_WIDTH * min(columns, len(slugs)), CHART_HEIGHT * rows
+    path = os.path.join(output_dir, f"contact_sheet.{fmt}")
+    if fmt == 'png':
+        from PIL import Image
+        sheet = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+        for i, slug in enumerate(slugs):
+            with Image.open(os.path.join(output_dir, chart_file_name(slug, fmt))) as chart:
+                sheet.paste(chart, ((i % columns) * CHART_WIDTH, (i // columns) * CHART_HEIGHT), chart)
+        sheet.save(path)
+    else:
+        parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">',
+                 f'<rect width="{width}" height="{height}" fill="#fff"/>']
+        for i, slug in enumerate(slugs):
+            player_name, scores = charts[slug]
+            parts.append(render_chart_svg(player_name, scores, x=(i % columns) * CHART_WIDTH, y=(i // columns) * CHART_HEIGHT))
+        parts.append('</svg>')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(parts))
+    return path
+
+def render_charts_locally(charts, output_dir=None, fmt=None, workers=None):
+    """
+    Rende in locale {slug: (nome, punteggi)} come file SVG/PNG su un process pool.
+    Un manifest con gli hash di contenuto evita di rigenerare i grafici invariati.
+    Ritorna il numero di grafici rigenerati.
+    """
+    output_dir, fmt = output_dir or CHART_OUTPUT_DIR, (fmt or CHART_OUTPUT_FORMAT).lower()
+    if fmt not in ('svg', 'png'):
+        raise ValueError(f"Formato grafici non supportato: {fmt}")
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    try:
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if manifest.get('format') != fmt:
+        manifest = {'format': fmt, 'charts': {}}
+
+    old_charts, new_charts, jobs = manifest['charts'], {}, []
+    for slug, (player_name, scores) in charts.items():
+        content_hash = chart_content_hash(player_name, scores)
+        file_name = chart_file_name(slug, fmt)
+        new_charts[slug] = {'player_name': player_name, 'hash': content_hash, 'file': file_name}
+        if old_charts.get(slug, {}).get('hash') != content_hash or not os.path.exists(os.path.join(output_dir, file_name)):
+            jobs.append((slug, player_name, scores, output_dir, fmt))
+    for slug in old_charts.keys() - charts.keys():
+        try:
+            os.remove(os.path.join(output_dir, old_charts[slug]['file']))
+        except OSError:
+            pass
+
+    print(f"Rendering locale: {len(jobs)} grafici da generare, {len(charts) - len(jobs)} invariati.")
+    if jobs:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(_render_chart_file, jobs, chunksize=max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))):
+                pass
+    if jobs or old_charts.keys() != charts.keys():
+        if charts:
+            print(f"Contact sheet scritto in {build_contact_sheet(charts, output_dir, fmt)}")
+        manifest['charts'] = new_charts
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    return len(jobs)
+
+def render_so5_charts():
+    """Legge i punteggi dal foglio principale e rende i grafici in locale in CHART_OUTPUT_DIR."""
+    for user_slug, spreadsheet_id in get_galleries():
+        print(f"--- INIZIO RENDERING LOCALE GRAFICI SO5{gallery_label(user_slug)} ---")
+        try:
+            main_sheet = get_gspread_client().open_by_key(spreadsheet_id).worksheet(MAIN_SHEET_NAME)
+        except Exception as e:
+            print(f"ERRORE CRITICO GSheets: {e}")
             continue
+        # In modalità multi-galleria ogni utente ha la sua sottocartella
+        output_dir = os.path.join(CHART_OUTPUT_DIR, user_slug) if GALLERIES_JSON else CHART_OUTPUT_DIR
+        charts = collect_chart_series(read_chart_records(main_sheet))
+        rendered = render_charts_locally(charts, output_dir)
+        print(f"--- RENDERING COMPLETATO. {rendered} grafici generati in '{output_dir}' ({len(charts)} totali). ---")
 
-        player_name = player.get("Player Name")
-        # The API gives scores from most recent to least recent. We reverse for the chart to show recent on right.
-        reversed_scores = scores[::-1]
-
-        # Generate chart config and URL
-        chart_config = generate_chart_config(player_name, reversed_scores)
-        config_str = json.dumps(chart_config, separators=(',', ':'))
-        encoded_config = urllib.parse.quote(config_str)
-        chart_url = f"https://quickchart.io/chart?w=500&h=300&bkg=transparent&c={encoded_config}"
-
-        # Add player name and the raw chart URL to the update list
-        row_index = i + 2  # +2 because sheet is 1-indexed and we have a header
-        update_data.append({'range': f'A{row_index}', 'values': [[player_name]]})
-        update_data.append({'range': f'B{row_index}', 'values': [[chart_url]]})
-
-    # Batch write all formulas to the sheet
-    if update_data:
-        print(f"Scrittura di {len(players_with_scores)} grafici nel foglio...")
-        chart_sheet.batch_update(update_data, value_input_option='USER_ENTERED')
-
-    # Adjust column and row sizes
-    chart_sheet.freeze(rows=1)
-    chart_sheet.update_acell('C1', "Nota: I grafici sono immagini generate da QuickChart.io")
-    spreadsheet.batch_update({
-        "requests": [
-            {"updateSheetProperties": {"properties": {"sheetId": chart_sheet.id, "gridProperties": {"frozenRowCount": 1}},"fields": "gridProperties.frozenRowCount"}},
-            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "COLUMNS", "startIndex": 0, "endIndex": 1}, "properties": {"pixelSize": 200}, "fields": "pixelSize"}},
-            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "COLUMNS", "startIndex": 1, "endIndex": 2}, "properties": {"pixelSize": 510}, "fields": "pixelSize"}},
-            {"updateDimensionProperties": {"range": {"sheetId": chart_sheet.id, "dimension": "ROWS", "startIndex": 1, "endIndex": len(players_with_scores) + 1}, "properties": {"pixelSize": 310}, "fields": "pixelSize"}},
-        ]
-    })
+# --- 6. CATTURA E REPLAY DEL TRAFFICO ---
+_original_session_request = None
+_real_sleep = time.sleep
+
+def traffic_request_key(method, url, args, kwargs):
+    """Chiave deterministica di una richiesta: metodo, URL completo di query e hash del corpo."""
+    prepared = requests.Request(
+        method=method, url=url,
+        params=kwargs.get("params", args[0] if args else None),
+        data=kwargs.get("data", args[1] if len(args) > 1 else None),
+        json=kwargs.get("json"),
+    ).prepare()
+    body = prepared.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return prepared.method, prepared.url, hashlib.sha1(body).hexdigest()
+
+def is_excluded_host(url):
+    return urllib.parse.urlsplit(url).hostname in TRAFFIC_EXCLUDED_HOSTS
+
+class TrafficRecorder:
+    """Scrive ogni scambio richiesta/risposta come riga JSON in un archivio gzip (senza header né segreti)."""
+    def __init__(self, path, initial_state):
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.write({"type": "meta", "command": sys.argv[1:], "recorded_at": time.time(), "state": initial_state})
+        self.count = 0
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def request(self, session, method, url, *args, **kwargs):
+        started = time.time()
+        response = _original_session_request(session, method, url, *args, **kwargs)
+        if not is_excluded_host(url):
+            method_name, full_url, body_hash = traffic_request_key(method, url, args, kwargs)
+            self.write({
+                "type": "exchange", "method": method_name, "url": full_url, "body": body_hash,
+                "status": response.status_code, "content_type": response.headers.get("Content-Type", ""),
+                "content": response.content.decode("utf-8", errors="replace"), "elapsed": round(time.time() - started, 4),
+            })
+            self.count += 1
+        return response
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        print(f"Cattura traffico completata: {self.count} scambi registrati.")
+
+class TrafficReplayer:
+    """
+    Risponde alle richieste HTTP dall'archivio. Ogni scambio si usa una volta sola: prima si
+    cerca la richiesta identica, poi (per le scritture con timestamp diversi) la prossima
+    risposta registrata sullo stesso metodo e percorso.
+    """
+    def __init__(self, path, latency):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.exchanges, self.used, self.meta = [], [], {}
+        self.by_key, self.by_path = {}, {}
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry["type"] == "meta":
+                        self.meta = entry
+                        continue
+                    idx = len(self.exchanges)
+                    self.exchanges.append(entry)
+                    self.used.append(False)
+                    self.by_key.setdefault((entry["method"], entry["url"], entry["body"]), []).append(idx)
+                    self.by_path.setdefault((entry["method"], urllib.parse.urlsplit(entry["url"]).path), []).append(idx)
+        except (EOFError, json.JSONDecodeError):
+            print("AVVISO: archivio troncato (esecuzione catturata interrotta?). Uso gli scambi letti finora.")
+        for pending in list(self.by_key.values()) + list(self.by_path.values()):
+            pending.reverse()  # pop() dalla coda = ordine di registrazione
+        print(f"Replay da {path}: {len(self.exchanges)} scambi, latenza {latency}.")
+
+    def _take(self, pending):
+        while pending:
+            idx = pending.pop()
+            if not self.used[idx]:
+                self.used[idx] = True
+                return self.exchanges[idx]
+        return None
+
+    def request(self, session, method, url, *args, **kwargs):
+        method_name, full_url, body_hash = traffic_request_key(method, url, args, kwargs)
+        response = requests.models.Response()
+        response.url, response.encoding = full_url, "utf-8"
+        if is_excluded_host(url):
+            response.status_code, response._content = 200, b'{"ok": true}'
+            return response
+        with self.lock:
+            exchange = self._take(self.by_key.get((method_name, full_url, body_hash), []))
+            if exchange is None:
+                exchange = self._take(self.by_path.get((method_name, urllib.parse.urlsplit(full_url).path), []))
+        if exchange is None:
+            raise requests.exceptions.ConnectionError(f"Replay: richiesta non presente nell'archivio: {method_name} {full_url}")
+        if self.latency == "real":
+            _real_sleep(exchange["elapsed"])
+        response.status_code = exchange["status"]
+        response.headers["Content-Type"] = exchange["content_type"]
+        response._content = exchange["content"].encode("utf-8")
+        return response
+
+def install_traffic_hook(handler):
+    """Intercetta tutte le richieste HTTP (requests.post/get e sessioni gspread) passando da handler."""
+    global _original_session_request
+    _original_session_request = requests.sessions.Session.request
+    def patched_request(session, method, url, *args, **kwargs):
+        return handler(session, method, url, *args, **kwargs)
+    requests.sessions.Session.request = patched_request
+
+def setup_traffic_mode():
+    """Attiva cattura o replay secondo la configurazione. In replay lo stato parte dalla fotografia dell'archivio, in un file separato."""
+    global STATE_FILE, SHARD_STATE_FILE_PREFIX
+    if TRAFFIC_REPLAY_FILE:
+        replayer = TrafficReplayer(TRAFFIC_REPLAY_FILE, REPLAY_LATENCY)
+        STATE_FILE, SHARD_STATE_FILE_PREFIX = REPLAY_STATE_FILE, "state.replay.shard"
+        save_state(replayer.meta.get("state") or {})
+        if REPLAY_LATENCY == "zero":
+            time.sleep = lambda seconds: None
+        install_traffic_hook(replayer.request)
+    elif TRAFFIC_CAPTURE_FILE:
+        recorder = TrafficRecorder(TRAFFIC_CAPTURE_FILE, load_state())
+        atexit.register(recorder.close)
+        install_traffic_hook(recorder.request)
+
+def apply_cli_options(argv):
+    """Estrae le opzioni comuni (--capture, --replay, --replay-latency, --profile) e ritorna gli argomenti restanti."""
+    global TRAFFIC_CAPTURE_FILE, TRAFFIC_REPLAY_FILE, REPLAY_LATENCY, PROFILE_ENABLED
+    remaining, args = [], list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == "--profile":
+            PROFILE_ENABLED = True
+        elif arg == "--capture" and args:
+            TRAFFIC_CAPTURE_FILE = args.pop(0)
+        elif arg == "--replay" and args:
+            TRAFFIC_REPLAY_FILE = args.pop(0)
+        elif arg == "--replay-latency" and args:
+            REPLAY_LATENCY = args.pop(0)
+        else:
+            remaining.append(arg)
+    setup_traffic_mode()
+    return remaining
+
+# --- 7. PROFILAZIONE ---
+class StackSampler:
+    """
+    Campionatore statistico basato su SIGPROF: a ogni intervallo di CPU registra lo stack di
+    tutti i thread in formato "collapsed" (radice;...;foglia conteggio), leggibile dai flamegraph.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = {}
+        self.previous = None  # (handler, itimer) trovati all'avvio, ripristinati da stop()
+
+    def _sample(self, signum, frame):
+        frames = sys._current_frames()
+        frames[threading.get_ident()] = frame  # Per il thread principale: il frame interrotto, non l'handler
+        for thread_frame in frames.values():
+            stack = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                thread_frame = thread_frame.f_back
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
 
-    print(f"--- CREAZIONE GRAFICI COMPLETATA. {len(players_with_scores)} grafici aggiunti a '{CHART_SHEET_NAME}'. ---")
+    def start(self):
+        if not hasattr(signal, "setitimer"):
+            print("AVVISO: SIGPROF non disponibile su questa piattaforma, niente stack campionati.")
+            return
+        self.previous = (signal.getsignal(signal.SIGPROF), signal.getitimer(signal.ITIMER_PROF))
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if self.previous is None:
+            return
+        handler, (delay, interval) = self.previous
+        # Un eventuale timer esterno riparte col suo gestore: SIG_DFL su SIGPROF terminerebbe il processo
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, handler if handler is not None else signal.SIG_DFL)
+        signal.setitimer(signal.ITIMER_PROF, delay, interval)
+        self.previous = None
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+
+class ThreadProfilers:
+    """
+    cProfile vede solo il thread che lo abilita: con threading.setprofile ogni thread avviato
+    durante la fase (pipeline di update_cards, pool di pagine...) abilita un proprio profiler
+    al primo evento, e le statistiche vengono poi sommate a quelle del thread principale.
+    """
+    def __init__(self):
+        self.profilers, self.lock = [], threading.Lock()
+
+    def _start_thread(self, frame, event, arg):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()  # Sostituisce questo hook per il resto del thread
+        except ValueError:
+            # Python 3.12+: un solo profiler attivo per processo, il thread resta senza
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.profilers.append(profiler)
+
+    def start(self):
+        threading.setprofile(self._start_thread)
+
+    def stop(self):
+        threading.setprofile(None)
+
+    def merge_into(self, stats):
+        with self.lock:
+            for profiler in self.profilers:
+                stats.add(profiler)
+        return stats
+
+_profiled_stage = None  # Fase sotto profilazione: le fasi annidate (job del demone) ci rientrano
+
+def run_stage(stage_name, func, *args):
+    """
+    Esegue una fase; con la profilazione attiva salva <fase>.prof e <fase>.collapsed e stampa le
+    funzioni più costose. Una fase lanciata dentro un'altra già profilata (i job del demone) non
+    avvia un secondo profiler: cProfile e SIGPROF sono uno per processo e finisce nel profilo esterno.
+    """
+    global _profiled_stage
+    if not PROFILE_ENABLED:
+        return func(*args)
+    if _profiled_stage is not None:
+        print(f"--- PROFILO: {stage_name} incluso nel profilo di {_profiled_stage} ---")
+        return func(*args)
+    _profiled_stage = stage_name
+    os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+    profiler, sampler, thread_profilers = cProfile.Profile(), StackSampler(PROFILE_SAMPLE_INTERVAL), ThreadProfilers()
+    sampler.start()
+    thread_profilers.start()
+    profiler.enable()
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        thread_profilers.stop()
+        sampler.stop()
+        _profiled_stage = None
+        prof_path = os.path.join(PROFILE_OUTPUT_DIR, f"{stage_name}.prof")
+        collapsed_path = os.path.join(PROFILE_OUTPUT_DIR, f"{stage_name}.collapsed")
+        stats = thread_profilers.merge_into(pstats.Stats(profiler, stream=sys.stdout))
+        stats.dump_stats(prof_path)
+        sampler.write(collapsed_path)
+        print(f"--- PROFILO {stage_name}: {prof_path}, {collapsed_path} ({sum(sampler.counts.values())} campioni, {len(thread_profilers.profilers)} thread secondari) ---")
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP_N)
+
+# --- 8. MODALITÀ DEMONE ---
+DAEMON_STOP = threading.Event()
+_daemon_job_running = False
+
+def handle_daemon_signal(signum, frame):
+    """Primo segnale: il demone si ferma. Un job in corso viene interrotto con SystemExit, così salva il checkpoint."""
+    print(f"[demone] Segnale {signum} ricevuto: arresto in corso...")
+    DAEMON_STOP.set()
+    if _daemon_job_running:
+        raise SystemExit(128 + signum)
+
+def reset_run_caches():
+    """Le cache "per esecuzione" (giocatori, proiezioni, vendite) non devono sopravvivere tra un job e l'altro."""
+    PLAYER_INFO_CACHE.clear()
+    PROJECTION_CACHE.clear()
+    TOKEN_PRICES_CACHE.clear()
+
+def run_check_lineups():
+    # check_lineups importa "gestionale": deve ritrovare questo stesso modulo (stato e client condivisi)
+    sys.modules.setdefault("gestionale", sys.modules[__name__])
+    import check_lineups
+    check_lineups.main()
+
+def run_daemon():
+    """
+    Processo continuo per un host Linux: client, cache e stato restano in memoria e i job
+    vengono eseguiti da uno scheduler a heap (orario, priorità) secondo i loro intervalli.
+    """
+    global _state_memory, _daemon_job_running
+    intervals = {name: minutes * 60 for name, minutes, _ in DAEMON_JOBS}
+    if DAEMON_INTERVALS_JSON:
+        try:
+            overrides = {name: float(minutes) * 60 for name, minutes in json.loads(DAEMON_INTERVALS_JSON).items() if name in intervals}
+            intervals.update(overrides)
+        except (ValueError, TypeError, AttributeError) as e:
+            # Un DAEMON_INTERVALS malformato non deve fermare il demone
+            print(f"[demone] AVVISO: DAEMON_INTERVALS non valido ({e}). Uso gli intervalli predefiniti.")
+    jobs = dict(COMMANDS, check_lineups=run_check_lineups)
+    _state_memory = load_state()
+    signal.signal(signal.SIGTERM, handle_daemon_signal)
+    signal.signal(signal.SIGINT, handle_daemon_signal)
+    heap = [(time.time(), priority, name) for name, _, priority in DAEMON_JOBS]
+    heapq.heapify(heap)
+    print(f"[demone] Avviato con {len(heap)} job: " + ", ".join(f"{name} ogni {int(intervals[name] // 60)} min" for _, _, name in sorted(heap)))
+    while not DAEMON_STOP.is_set():
+        due, priority, name = heap[0]
+        delay = due - time.time()
+        if delay > 0:
+            DAEMON_STOP.wait(min(delay, DAEMON_IDLE_CHECK_SECONDS))
+            continue
+        heapq.heappop(heap)
+        reset_run_caches()
+        print(f"[demone] {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} avvio {name}")
+        job_start = time.time()
+        _daemon_job_running = True
+        try:
+            run_stage(name, jobs[name])
+        except SystemExit:
+            break
+        except Exception as e:
+            print(f"[demone] Errore in {name}: {e}")
+        finally:
+            _daemon_job_running = False
+        print(f"[demone] {name} completato in {time.time() - job_start:.1f}s")
+        # Un job più lungo del suo intervallo ripartirà subito, ma dopo quelli già scaduti
+        heapq.heappush(heap, (max(due + intervals[name], time.time()), priority, name))
+    print("[demone] Arrestato. Stato salvato.")
+
+COMMANDS = {
+    "sync_galleria": sync_galleria,
+    "update_cards": update_cards,
+    "update_sales": update_sales,
+    "update_floors": update_floors,
+    "create_charts": create_so5_charts,
+    "render_charts": render_so5_charts,
+    "merge_shards": merge_shard_states,
+    "valuation": update_valuation,
+    "daemon": run_daemon,
+}
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        function_to_run = sys.argv[1]
-        if function_to_run == "sync_galleria": 
-            sync_galleria()
-        elif function_to_run == "update_cards": 
-            update_cards()
-        elif function_to_run == "update_sales": 
-            update_sales()
-        elif function_to_run == "update_floors": 
-            update_floors()
-        elif function_to_run == "create_charts": 
-            create_so5_charts()
+    signal.signal(signal.SIGTERM, handle_termination)
+    cli_args = apply_cli_options(sys.argv[1:])
+    if cli_args:
+        function_to_run = cli_args[0]
+        if function_to_run in COMMANDS: 
+            run_stage(function_to_run, COMMANDS[function_to_run])
         else: 
             print(f"Errore: Funzione '{function_to_run}' non riconosciuta.")
     else:
-        print("Nessuna funzione specificata. Le funzioni disponibili sono: sync_galleria, update_cards, update_sales, update_floors, create_charts.")
+        print(f"Nessuna funzione specificata. Le funzioni disponibili sono: {', '.join(COMMANDS)}.")